@@ -0,0 +1,87 @@
+"""Remember where catalog number barcodes are found on an imaging station."""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+REGION_LOGGER = logging.getLogger('session_log')
+REGION_HISTORY = 20  # recent barcode positions used to build the region
+REGION_MARGIN = 0.05  # added around the region, as a fraction of the image size
+SAVE_EVERY = 10  # learned positions between writes of the region file
+
+
+def region_path(station_uuid=None):
+    """Return the path of the region file for an imaging station."""
+    if station_uuid:
+        return 'barcode_region_' + station_uuid + '.json'
+    return 'barcode_region_UNIDENTIFIED_STATION.json'
+
+
+class BarcodeRegion():
+    """
+    Region of the frame where catalog number barcodes were found in recent images.
+
+    Herbarium sheets on a copy stand put the barcode in nearly the same place,
+    so decoding a crop of this region first usually finds the barcode much
+    faster than scanning the whole frame. Positions are normalized bounding
+    boxes [left, top, right, bottom] in the range 0-1.
+    """
+
+    def __init__(self, path=None, history=REGION_HISTORY, margin=REGION_MARGIN):
+        self.path = path
+        self.margin = margin
+        self.boxes = collections.deque(maxlen=history)
+        self.learned_count = 0
+        self.lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as region_file:
+                    self.boxes.extend(json.load(region_file)['boxes'])
+            except (OSError, ValueError, KeyError) as e:
+                print('BarcodeRegion: unable to read', path, e)
+                REGION_LOGGER.exception('Unable to read barcode region file: ' + path)
+
+    def region(self):
+        """
+        Return the box enclosing recent barcode positions plus a margin.
+
+        Returns
+        -------
+        list
+            [left, top, right, bottom], or None until a position has been learned.
+        """
+        with self.lock:
+            if not self.boxes:
+                return None
+            left = min(box[0] for box in self.boxes) - self.margin
+            top = min(box[1] for box in self.boxes) - self.margin
+            right = max(box[2] for box in self.boxes) + self.margin
+            bottom = max(box[3] for box in self.boxes) + self.margin
+        return [max(0.0, left), max(0.0, top), min(1.0, right), min(1.0, bottom)]
+
+    def learn(self, barcodes_list=None):
+        """Add the positions of catalog number barcodes found in an image."""
+        learned = False
+        with self.lock:
+            for barcode in barcodes_list or []:
+                if barcode.get('rect'):
+                    self.boxes.append(barcode['rect'])
+                    learned = True
+            if learned:
+                self.learned_count += 1
+        if learned and self.learned_count % SAVE_EVERY == 0:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            boxes = list(self.boxes)
+        try:
+            with open(self.path, 'w') as region_file:
+                json.dump({'boxes': boxes}, region_file, indent=4)
+        except OSError as e:
+            print('BarcodeRegion: unable to write', self.path, e)
+            REGION_LOGGER.exception('Unable to write barcode region file: ' + self.path)
@@ -0,0 +1,228 @@
+"""Process an existing session folder as a batch instead of monitoring it live."""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import time
+import types
+import uuid
+
+import click
+
+import client
+import pipeline
+import processing_cache
+import rename_plan
+
+BATCH_LOGGER = logging.getLogger('session_log')
+
+
+def scan_session_directory(path=None):
+    """
+    Find image files in a session folder and pair raw and derived files by name.
+
+    Parameters
+    ----------
+    path : string
+
+    Returns
+    -------
+    dict
+        (directory, original filename without extension): {'raw': path, 'derived': path}.
+        Files are only paired within a folder, subfolders may reuse file names.
+    """
+    image_pairs = {}
+    for entry in pipeline.scan_image_files(path):
+        filename, file_extension = os.path.splitext(entry.name)
+        key = (os.path.dirname(entry.path), filename)
+        if file_extension.upper() in pipeline.RAW_IMAGE_EXTENSIONS:
+            image_pairs.setdefault(key, {})['raw'] = entry.path
+        else:
+            image_pairs.setdefault(key, {})['derived'] = entry.path
+    return image_pairs
+
+
+def read_event_records(path=None):
+    """
+    Read the image event JSON files of a session folder processed before.
+
+    Returns
+    -------
+    dict
+        Normcased image path, original or renamed: event record.
+    """
+    records = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.name.upper().endswith('.JSON') or entry.name.lower().endswith(rename_plan.MANIFEST_EXTENSION):
+                continue
+            try:
+                with open(entry.path) as json_file:
+                    record = json.load(json_file)
+            except (OSError, ValueError) as e:
+                print('Unable to read', entry.path, e)
+                continue
+            if not isinstance(record, dict) or 'id' not in record:
+                continue
+            for original_field, new_field in rename_plan.IMAGE_FIELDS:
+                for field in [original_field, new_field]:
+                    if record.get(field):
+                        records[os.path.normcase(record[field])] = record
+    return records
+
+
+def reuse_event_record(image_event=None, image_pair=None, event_records=None):
+    """
+    Give an image event the id and session of the record of its files, if they were processed before.
+
+    The event JSON file is then replaced rather than written again under a
+    new UUID. Files renamed by the earlier run keep their original names.
+    """
+    for image_path in [image_pair.get('raw'), image_pair.get('derived')]:
+        record = event_records.get(os.path.normcase(image_path)) if image_path else None
+        if record is not None:
+            break
+    else:
+        return False
+    image_event.id = record['id']
+    image_event.session_uuid = record.get('session_uuid', image_event.session_uuid)
+    for original_field, new_field in rename_plan.IMAGE_FIELDS:
+        image_path = getattr(image_event, original_field)
+        if image_path and record.get(new_field) and \
+                os.path.normcase(record[new_field]) == os.path.normcase(image_path):
+            setattr(image_event, original_field, record.get(original_field))
+            setattr(image_event, new_field, record[new_field])
+            image_event.original_filename = record.get('original_filename', image_event.original_filename)
+    return True
+
+
+def process_image_pair(session_info=None, image_pair=None, cache=None, symbologies=None,
+                       read_raw_preview=False, catalog_number_rules=None, fixity_digests=None):
+    """
+    Create the image event for a raw/derived file pair.
+
+    Runs in a worker process, session_info holds the session values
+    copied into ImageEvent. Files are renamed and JSON records written by
+    the parent process, so workers never choose the same file name.
+
+    Returns
+    -------
+    tuple
+        (image event, file count, bytes read, barcode decoding scale counts)
+    """
+    if catalog_number_rules is not None:
+        # Worker processes do not create a Client, so the station rules are set here
+        client.CATALOG_NUMBER_RULES = catalog_number_rules
+    image_event = None
+    bytes_read = 0
+    barcode_scale_counts = collections.Counter()
+    # the raw file's preview is only decoded when there is no derived image to read barcodes from
+    read_raw_preview = read_raw_preview and 'derived' not in image_pair
+    for image_path in [image_pair.get('raw'), image_pair.get('derived')]:
+        if image_path is None:
+            continue
+        file_metadata = pipeline.analyze_image_file(image_path=image_path, cache=cache, symbologies=symbologies,
+                                                    read_raw_preview=read_raw_preview,
+                                                    catalog_number_rules=catalog_number_rules,
+                                                    fixity_digests=fixity_digests)
+        if image_event is None:
+            image_event = client.ImageEvent(session=session_info, original_image_path=image_path,
+                                            file_metadata=file_metadata)
+        else:
+            image_event.update_image_event(original_image_path=image_path, file_metadata=file_metadata)
+        bytes_read += os.path.getsize(image_path)
+        barcode_scale_counts.update(file_metadata.get('barcode_scales', {}))
+    return image_event, len(image_pair), bytes_read, barcode_scale_counts
+
+
+@click.command()
+@click.option('-d', '--directory', help='Specify session directory.', type=click.Path(exists=True, file_okay=False))
+@click.option('-u', '--username', help='Your first initial and last name')
+@click.option('-c', '--collection', help='The collection code (e.g. VDB, BRIT)')
+@click.option('-p', '--project', help='The project code (e.g. Crataegus, TX-digi)')
+@click.option('-w', '--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs).')
+@click.option('--rename/--no-rename', default=False, help='Rename image files using the catalog number.')
+def main(directory=None, username=None, collection=None, project=None, workers=None, rename=False):
+    if not directory:
+        directory = click.prompt('Please enter the path of the session folder', type=click.Path(exists=True))
+    if not username:
+        username = click.prompt('Please enter your first and last name')
+    if not collection:
+        collection = click.prompt('Please enter the collection code (e.g. VDB, BRIT)')
+    if not project:
+        project = click.prompt('Please enter the project code (use \'none\' if no project or unknown.)')
+    directory = os.path.abspath(directory)
+    client_instance = client.Client()
+    # events processed before keep their id, so their JSON files are replaced instead of duplicated
+    event_records = read_event_records(directory)
+    session_uuids = set(record.get('session_uuid') for record in event_records.values())
+    session_uuid = session_uuids.pop() if len(session_uuids) == 1 and None not in session_uuids \
+        else str(uuid.uuid4())
+    # Plain values only, this is sent to every worker process.
+    session_info = types.SimpleNamespace(
+        uuid=session_uuid, path=directory, username=username, collection_code=collection,
+        project_code=project, notes=None, taxa=None,
+        client_instance=types.SimpleNamespace(station_uuid=client_instance.station_uuid,
+                                              station_id=client_instance.station_id))
+    BATCH_LOGGER.info('Batch session ' + session_info.uuid + ' started for: ' + directory)
+    cache = None
+    if client_instance.use_processing_cache:
+        cache = processing_cache.ProcessingCache(os.path.join(directory, processing_cache.CACHE_FILENAME))
+
+    start_time = time.perf_counter()
+    image_pairs = list(scan_session_directory(directory).values())
+    print('Found', len(image_pairs), 'image events in', directory)
+    event_count = 0
+    file_count = 0
+    bytes_read = 0
+    missing_catalog_numbers = 0
+    reprocessed_count = 0
+    barcode_scale_counts = collections.Counter()
+    image_events = {}  # index of the pair in image_pairs: ImageEvent
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_image_pair, session_info, image_pair, cache,
+                                   client_instance.barcode_symbologies, client_instance.read_raw_preview,
+                                   client_instance.catalog_number_rules, client_instance.fixity_digests): index
+                   for index, image_pair in enumerate(image_pairs)}
+        with click.progressbar(concurrent.futures.as_completed(futures), length=len(futures),
+                               label='Processing') as completed:
+            for future in completed:
+                try:
+                    image_event, pair_file_count, pair_bytes_read, pair_scale_counts = future.result()
+                except Exception as e:
+                    print('ERROR processing image event:', e)
+                    BATCH_LOGGER.exception('Batch worker failed.')
+                    continue
+                if reuse_event_record(image_event, image_pairs[futures[future]], event_records):
+                    reprocessed_count += 1
+                event_count += 1
+                file_count += pair_file_count
+                bytes_read += pair_bytes_read
+                barcode_scale_counts.update(pair_scale_counts)
+                image_events[futures[future]] = image_event
+                if image_event.catalog_number is None:
+                    missing_catalog_numbers += 1
+    # in folder order, so the first event of a catalog number gets the plain name whatever the worker timing
+    image_events = [image_events[index] for index in sorted(image_events)]
+    if rename:
+        plan = rename_plan.RenamePlan(image_events)
+        print('Renaming', len(plan.renames), 'image files.')
+        plan.execute(manifest_path=rename_plan.manifest_path(directory, session_info.uuid))
+    for image_event in image_events:
+        image_event.serialize_image_event()
+    elapsed = time.perf_counter() - start_time
+
+    print('Image events processed:', event_count, 'files:', file_count)
+    print('Image events processed before, JSON files replaced:', reprocessed_count)
+    print('Image events without catalog number:', missing_catalog_numbers)
+    print('Barcode decoding scales:', dict(barcode_scale_counts))
+    if elapsed > 0:
+        print(f'Elapsed: {elapsed:.1f} s, {event_count / elapsed:.1f} events/s, '
+              f'{bytes_read / elapsed / 1048576:.1f} MB/s')
+    BATCH_LOGGER.info('Batch session ' + session_info.uuid + ' processed ' + str(event_count) + ' image events.')
+
+
+if __name__ == '__main__':
+    main()
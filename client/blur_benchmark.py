@@ -0,0 +1,78 @@
+"""Compare the speed and agreement of blur engines on folders of sample images."""
+
+import itertools
+import time
+
+import click
+
+import blur_calibration
+import blur_engines
+
+
+@click.command()
+@click.argument('folders', nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('-e', '--engine', 'engine_names', multiple=True, default=['haar', 'laplacian'],
+              help='Engine to compare, repeatable.')
+@click.option('-s', '--scale', type=int, default=None, help='Scale used by every engine, default is each engine\'s own.')
+@click.option('-t', '--threshold', type=float, default=blur_engines.DEFAULT_LAPLACIAN_THRESHOLD, show_default=True,
+              help='Laplacian variance threshold.')
+@click.option('-r', '--region', default=None, help='Laplacian region as left, top, right, bottom.')
+def benchmark(folders=None, engine_names=None, scale=None, threshold=None, region=None):
+    """
+    Time each blur engine on the images in FOLDERS and report how often they agree.
+
+    Images in blurry and sharp folders are also compared with their label.
+    """
+    engines = []
+    for name in engine_names:
+        options = {}
+        if scale is not None:
+            options['scale'] = scale
+        if name == blur_engines.LaplacianEngine.name:
+            options['threshold'] = threshold
+            options['region'] = blur_engines.parse_region(region)
+        engine = blur_engines.create_engine(name, **options)
+        if engine is not None:
+            engines.append(engine)
+    images = []
+    for folder in folders:
+        images.extend(blur_calibration.labeled_images(folder))
+    print('Found', len(images), 'images.')
+
+    # engine name: list of is_blurry, None where the engine failed
+    results = {engine.name: [] for engine in engines}
+    elapsed = {engine.name: 0.0 for engine in engines}
+    with click.progressbar(images, label='Evaluating') as progress:
+        for image_path, label in progress:
+            for engine in engines:
+                start_time = time.perf_counter()
+                try:
+                    is_blurry, blurriness = engine.evaluate(image=image_path)
+                except (ZeroDivisionError, OSError, ValueError):
+                    is_blurry = None
+                elapsed[engine.name] += time.perf_counter() - start_time
+                results[engine.name].append(is_blurry)
+
+    if not images:
+        return
+    labels = [label for image_path, label in images]
+    for engine in engines:
+        engine_results = results[engine.name]
+        blurry_count = sum(result is True for result in engine_results)
+        failed_count = sum(result is None for result in engine_results)
+        line = (f'{engine.name}: {elapsed[engine.name] / len(images):.3f}s per image, '
+                f'{blurry_count} blurry, {failed_count} failed')
+        labeled = [(result, label) for result, label in zip(engine_results, labels) if label is not None]
+        if labeled:
+            correct = sum(result == label for result, label in labeled)
+            line += f', {correct / len(labeled):.1%} of {len(labeled)} labeled images correct'
+        print(line)
+    for first, second in itertools.combinations(engines, 2):
+        pairs = [(a, b) for a, b in zip(results[first.name], results[second.name]) if a is not None and b is not None]
+        if pairs:
+            agreement = sum(a == b for a, b in pairs) / len(pairs)
+            print(f'{first.name} and {second.name} agree on {agreement:.1%} of {len(pairs)} images')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,144 @@
+"""Fit blur_detection thresholds for reduced scale evaluation against full resolution results."""
+
+import datetime
+import json
+import os
+import time
+
+import click
+import numpy
+
+import blur_detection
+
+IMAGE_EXTENSIONS = ['.JPG', '.JPEG', '.PNG', '.TIF', '.TIFF']
+# Folder names labeling the images they contain
+LABELS = {'blurry': True, 'sharp': False}
+# Haar edge energy changes with the scale, so candidates cover a wide range around the default 35
+THRESH_CANDIDATES = sorted(set(round(float(thresh), 1) for thresh in numpy.geomspace(5, 2000, 80)))
+
+
+def labeled_images(folder=None):
+    """
+    Find the images to calibrate with.
+
+    Images in a folder named blurry or sharp (at any depth) are labeled,
+    others are compared with the full resolution result only.
+
+    Returns
+    -------
+    list
+        (image path, label), label is True, False or None.
+    """
+    images = []
+    for directory, directory_names, file_names in os.walk(folder):
+        label = None
+        for part in os.path.relpath(directory, folder).split(os.sep):
+            label = LABELS.get(part.lower(), label)
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].upper() in IMAGE_EXTENSIONS:
+                images.append((os.path.join(directory, file_name), label))
+    return images
+
+
+def _per_values(emax_list=None, thresh=None):
+    """Return the Dirac and A-step edge fraction of each image, 0 for images without edges."""
+    per_values = []
+    for Emax1, Emax2, Emax3 in emax_list:
+        N_edge, N_da, N_rg, N_brg = blur_detection._edge_statistics(Emax1, Emax2, Emax3, thresh=thresh)
+        per_values.append(float(N_da) / N_edge if N_edge else 0.0)
+    return numpy.array(per_values)
+
+
+def fit_thresholds(emax_list=None, targets=None):
+    """
+    Grid search thresh and MinZero so that per <= MinZero reproduces the targets.
+
+    The edge maps of each image are computed once, so each candidate thresh
+    only reclassifies the edge blocks.
+
+    Returns
+    -------
+    tuple
+        (thresh, MinZero, fraction of targets reproduced)
+    """
+    targets = numpy.array(targets, dtype=bool)
+    best = None
+    for thresh in THRESH_CANDIDATES:
+        per_values = _per_values(emax_list, thresh)
+        sorted_per = numpy.unique(per_values)
+        # MinZero between each pair of neighbouring per values, plus below and above all of them
+        candidates = numpy.concatenate([[sorted_per[0] - 0.01], (sorted_per[:-1] + sorted_per[1:]) / 2,
+                                        [sorted_per[-1] + 0.01]])
+        for min_zero in candidates:
+            agreement = float(numpy.mean((per_values <= min_zero) == targets))
+            # prefer values close to the full resolution defaults on ties
+            distance = abs(numpy.log(thresh / blur_detection.DEFAULT_THRESH)) + abs(min_zero - blur_detection.DEFAULT_MIN_ZERO)
+            if best is None or (agreement, -distance) > (best[2], -best[3]):
+                best = (thresh, round(float(min_zero), 4), agreement, distance)
+    return best[:3]
+
+
+@click.command()
+@click.argument('folder', type=click.Path(exists=True, file_okay=False))
+@click.option('-s', '--scale', 'scales', type=click.Choice(['2', '4']), multiple=True, default=['2', '4'],
+              help='Reduced scale to calibrate, repeatable.')
+@click.option('-o', '--output', default=blur_detection.CALIBRATION_FILENAME, show_default=True,
+              help='Calibration file read by the client, see the BLUR section of config_local.ini.')
+def calibrate(folder=None, scales=None, output=None):
+    """
+    Calibrate reduced scale blur thresholds on the images in FOLDER.
+
+    Labeled images (in blurry and sharp folders) are fitted to their label,
+    other images to the full resolution result with the default thresholds.
+    """
+    scales = [int(scale) for scale in scales]
+    images = labeled_images(folder)
+    labeled_count = sum(label is not None for image_path, label in images)
+    print('Found', len(images), 'images,', labeled_count, 'labeled.')
+    targets = []
+    full_resolution_results = []
+    emax_by_scale = {scale: [] for scale in scales}
+    elapsed_by_scale = {scale: 0.0 for scale in [1] + scales}
+    with click.progressbar(images, label='Reading images') as progress:
+        for image_path, label in progress:
+            start_time = time.perf_counter()
+            try:
+                is_blurry, per, blur_extent = blur_detection.blur_detect(image=image_path)
+            except ZeroDivisionError:
+                # no edges found
+                is_blurry = True
+            except OSError as e:
+                print('Unable to read image:', image_path, e)
+                continue
+            elapsed_by_scale[1] += time.perf_counter() - start_time
+            full_resolution_results.append(is_blurry)
+            targets.append(is_blurry if label is None else label)
+            for scale in scales:
+                start_time = time.perf_counter()
+                emax_by_scale[scale].append(blur_detection._haar_emax(blur_detection.load_image(image_path, scale=scale)))
+                elapsed_by_scale[scale] += time.perf_counter() - start_time
+    if not targets:
+        print('No images to calibrate with.')
+        return
+    if labeled_count:
+        agreement = numpy.mean(numpy.array(full_resolution_results) == numpy.array(targets))
+        print(f'Full resolution defaults agree with {agreement:.1%} of targets, '
+              f'{elapsed_by_scale[1] / len(targets):.3f}s per image.')
+    calibration = {'calibrated': datetime.datetime.now().isoformat(), 'folder': os.path.abspath(folder),
+                   'images': len(targets), 'labeled_images': labeled_count, 'scales': {}}
+    for scale in scales:
+        thresh, min_zero, agreement = fit_thresholds(emax_by_scale[scale], targets)
+        full_resolution_agreement = float(numpy.mean(
+            (_per_values(emax_by_scale[scale], thresh) <= min_zero) == numpy.array(full_resolution_results)))
+        calibration['scales'][str(scale)] = {'thresh': thresh, 'MinZero': min_zero, 'agreement': round(agreement, 4),
+                                             'full_resolution_agreement': round(full_resolution_agreement, 4)}
+        print(f'Scale 1/{scale}: thresh {thresh} MinZero {min_zero}, agrees with {agreement:.1%} of targets '
+              f'and {full_resolution_agreement:.1%} of full resolution results, '
+              f'{elapsed_by_scale[scale] / len(targets):.3f}s per image to decode and transform.')
+    with open(output, 'w') as calibration_file:
+        json.dump(calibration, calibration_file, indent=4)
+    print('Saved calibration:', output)
+
+
+if __name__ == '__main__':
+    calibrate()
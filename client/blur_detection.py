@@ -7,21 +7,257 @@
 Copied from https://github.com/chihsuan/detect-blurry-video/blob/master/detect_blurry_image.py
 The original at https://gist.github.com/shahriman/3289170 is no longer available.
 """
-from PIL import Image
+import json
+import os
+from PIL import Image, ImageFilter
 import numpy
 import pywt
 import sys
+import tempfile
+import time
 
-def blur_detect(image=None, thresh=35, MinZero=0.05):
+import utilities
 
-    if type(image) is str: 
-        #image = Image.open(sys.argv[1]).convert('F')
-        #image = numpy.asarray(image)
-        image = Image.open(image).convert('F')
-        image = numpy.asarray(image)
+DEFAULT_THRESH = 35
+DEFAULT_MIN_ZERO = 0.05
+BLUR_SCALES = [1, 2, 4]  # supported reductions, JPEGs are reduced while decoding
+CALIBRATION_FILENAME = 'blur_calibration.json'
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024  # bytes used by tiled evaluation
+# Peak bytes per pixel of a strip: the float32 strip, the first level coefficients and edge map and temporaries
+TILE_BYTES_PER_PIXEL = 12
 
+
+def blur_detect(image=None, thresh=DEFAULT_THRESH, MinZero=DEFAULT_MIN_ZERO, cache=None, scale=1, memory_budget=None):
+    """
+    Evaluate the blurriness of an image, Tong et al. Haar wavelet method.
+
+    Parameters
+    ----------
+    image : string or numpy.ndarray
+        Image path or grayscale array.
+    thresh : float
+        Edge energy threshold.
+    MinZero : float
+        The image is blurry if the fraction of Dirac and A-step edges is at most MinZero.
+    cache : processing_cache.ProcessingCache
+    scale : int
+        Evaluate the image reduced by 2 or 4, thresh and MinZero should be
+        calibrated for the scale, see scale_thresholds.
+    memory_budget : int
+        Evaluate the image in strips using at most about memory_budget bytes
+        besides the decoded image, for very large images. Strips are converted
+        to grayscale from the same decode as load_image, so the result is
+        identical to evaluating the image at once.
+
+    Returns
+    -------
+    tuple
+        (is_blurry, per, BlurExtent)
+    """
+    if cache is not None and type(image) is str:
+        # cached results are only valid for the same parameters
+        cache_name = 'blur:' + str(thresh) + ':' + str(MinZero)
+        if scale != 1:
+            cache_name += ':' + str(scale)
+        if memory_budget:
+            cache_name += ':tiled'
+        found, result = cache.lookup(file_path=image, name=cache_name)
+        if found:
+            return tuple(result)
+        result = blur_detect(image=image, thresh=thresh, MinZero=MinZero, scale=scale, memory_budget=memory_budget)
+        cache.store(file_path=image, name=cache_name, value=list(result))
+        return result
+
+    if memory_budget:
+        # decoded image, converted to float32 grayscale one strip at a time
+        if type(image) is str:
+            image = open_image(image, scale=scale)
+        elif scale > 1:
+            image = load_image(image, scale=scale)
+        N_edge, N_da, N_rg, N_brg = _tiled_edge_statistics(image, thresh=thresh, memory_budget=memory_budget)
+    else:
+        image = load_image(image, scale=scale)
+        N_edge, N_da, N_rg, N_brg = _edge_statistics(*_haar_emax(image), thresh=thresh)
+    per = float(N_da) / N_edge
+    BlurExtent = float(N_brg) / N_rg
+
+    if per > MinZero:
+        return False, per, BlurExtent
+    else:
+        return True, per, BlurExtent
+
+
+def open_image(file_path=None, scale=1):
+    """
+    Open the image evaluated for a file, reduced by scale.
+
+    convert('F') gives the grayscale float32 values evaluated, whole or by strips.
+    """
+    if scale > 1:
+        return utilities.reduced_image(file_path=file_path, scale=scale, mode='L')
+    return Image.open(file_path)
+
+
+def load_image(image=None, scale=1):
+    """Return a grayscale float32 array of an image path or array, reduced by scale."""
+    if type(image) is str:
+        image = numpy.asarray(open_image(image, scale=scale).convert('F'))
+    elif scale > 1:
+        image = Image.fromarray(numpy.asarray(image, dtype=numpy.float32))
+        image = numpy.asarray(utilities.reduce_image(image, scale))
+    return image
+
+
+def haar_edge_maps(image=None):
+    """Return the edge maps of the three level Haar wavelet transform of the image, cropped to 16 pixel blocks."""
     # original:
     # x_cropped = image[0:(numpy.shape(image)[0]/16)*16 - 1, 0:(numpy.shape(image)[1]/16)*16 - 1]
+    x_cropped = image[0:(int(numpy.shape(image)[0]/16)*16 - 1), 0:(int(numpy.shape(image)[1]/16)*16 - 1)]
+    return _haar_energy(x_cropped)
+
+
+def _haar_energy(x_cropped=None):
+    """Return the edge maps of the three level Haar wavelet transform of an image or tile."""
+    LL1,(LH1,HL1,HH1) = pywt.dwt2(x_cropped,'haar')
+    Emap1 = numpy.square(LH1) + numpy.square(HL1) + numpy.square(HH1)
+    del LH1, HL1, HH1
+    LL2,(LH2,HL2,HH2) = pywt.dwt2(LL1      ,'haar')
+    del LL1
+    Emap2 = numpy.square(LH2) + numpy.square(HL2) + numpy.square(HH2)
+    LL3,(LH3,HL3,HH3) = pywt.dwt2(LL2      ,'haar')
+    Emap3 = numpy.square(LH3) + numpy.square(HL3) + numpy.square(HH3)
+    return Emap1, Emap2, Emap3
+
+
+def _haar_emax(image=None):
+    """
+    Return the local maxima Emax1, Emax2 and Emax3 of the Haar edge maps.
+
+    Each Emax has one value per 16x16 block of the image, less a two block border.
+    Emap1 has 8x8 values per block, Emax1 is the max of the 7x7 values at offset 1,
+    Emap2 has 4x4 values per block, Emax2 is the max of the 3x3 values at offset 1,
+    Emap3 has 2x2 values per block, Emax3 is the value at offset 1.
+    """
+    Emap1, Emap2, Emap3 = haar_edge_maps(image)
+    dimx = max(0, int(numpy.shape(Emap3)[0] / 2) - 2)
+    dimy = max(0, int(numpy.shape(Emap3)[1] / 2) - 2)
+    return _emax_blocks(Emap1, Emap2, Emap3, dimx, dimy)
+
+
+def _emax_blocks(Emap1=None, Emap2=None, Emap3=None, dimx=0, dimy=0):
+    """Return Emax1, Emax2 and Emax3 of the first dimx by dimy 16x16 blocks of the edge maps."""
+    Emax1 = Emap1[:8 * dimx, :8 * dimy].reshape(dimx, 8, dimy, 8)[:, 1:, :, 1:].max(axis=(1, 3), initial=0)
+    Emax2 = Emap2[:4 * dimx, :4 * dimy].reshape(dimx, 4, dimy, 4)[:, 1:, :, 1:].max(axis=(1, 3), initial=0)
+    Emax3 = Emap3[1:2 * dimx:2, 1:2 * dimy:2]
+    return Emax1, Emax2, Emax3
+
+
+def _tiled_edge_statistics(pixels=None, thresh=DEFAULT_THRESH, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Return the edge statistics of an image computed in strips of 16 pixel block rows.
+
+    Each 16x16 block's Emax values only depend on the pixels of the block, so
+    transforming strips of whole block rows and adding their counts gives the
+    same (N_edge, N_da, N_rg, N_brg) as _edge_statistics of the whole image.
+    Only one strip at a time is converted to float32 and transformed, strips
+    are sized so that this stays within memory_budget bytes.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray or PIL.Image.Image
+        Grayscale array of any dtype, or an image converted to grayscale ('F') by strips.
+    thresh : float
+    memory_budget : int
+    """
+    if isinstance(pixels, Image.Image):
+        height, full_width = pixels.size[1], pixels.size[0]
+    else:
+        height, full_width = pixels.shape
+    # the border of two blocks is not evaluated, as in blur_detect
+    dimx = max(0, int(height / 16) - 2)
+    dimy = max(0, int(full_width / 16) - 2)
+    # the image is cropped to 16 pixel blocks less a pixel, only the unevaluated last block column is padded
+    width = int(full_width / 16) * 16 - 1
+    strip_block_rows = max(1, int(memory_budget // (16 * width * TILE_BYTES_PER_PIXEL)))
+    totals = [0, 0, 0, 0]
+    for first_block_row in range(0, dimx, strip_block_rows):
+        block_rows = min(strip_block_rows, dimx - first_block_row)
+        top, bottom = 16 * first_block_row, 16 * (first_block_row + block_rows)
+        if isinstance(pixels, Image.Image):
+            strip = numpy.asarray(pixels.crop((0, top, width, bottom)).convert('F'))
+        else:
+            strip = numpy.asarray(pixels[top:bottom, :width], dtype=numpy.float32)
+        Emax1, Emax2, Emax3 = _emax_blocks(*_haar_energy(strip), dimx=block_rows, dimy=dimy)
+        del strip
+        for index, count in enumerate(_edge_statistics(Emax1, Emax2, Emax3, thresh=thresh)):
+            totals[index] += count
+    return tuple(totals)
+
+
+def _edge_statistics(Emax1=None, Emax2=None, Emax3=None, thresh=DEFAULT_THRESH):
+    """
+    Classify the edge blocks.
+
+    Returns
+    -------
+    tuple
+        (N_edge, N_da, N_rg, N_brg), counts of edges, Dirac and A-step edges,
+        Roof and G-step edges and blurred Roof and G-step edges. Images with
+        no edges give N_edge 0, blur_detect then raises ZeroDivisionError as
+        the original implementation did.
+    """
+    EdgeMap = (Emax1 > thresh) | (Emax2 > thresh) | (Emax3 > thresh)
+    Dirac_Astep = EdgeMap & (Emax1 > Emax2) & (Emax2 > Emax3)
+    Roof_Gstep = EdgeMap & ~Dirac_Astep & (((Emax1 < Emax2) & (Emax2 < Emax3)) |
+                                           ((Emax2 > Emax1) & (Emax2 > Emax3)))
+    N_edge = int(numpy.count_nonzero(EdgeMap))
+    N_da = int(numpy.count_nonzero(Dirac_Astep))
+    N_rg = int(numpy.count_nonzero(Roof_Gstep))
+    N_brg = int(numpy.count_nonzero(Roof_Gstep & (Emax1 < thresh)))
+    return N_edge, N_da, N_rg, N_brg
+
+
+def load_calibration(calibration_path=None):
+    """
+    Read per scale thresholds written by blur_calibration.py.
+
+    Returns
+    -------
+    dict
+        scale: {'thresh': float, 'MinZero': float}, empty if the file can not be read.
+    """
+    try:
+        with open(calibration_path) as calibration_file:
+            calibration = json.load(calibration_file)
+        return {int(scale): thresholds for scale, thresholds in calibration.get('scales', {}).items()}
+    except (OSError, ValueError, AttributeError) as e:
+        print('Unable to read blur calibration:', calibration_path, e)
+        return {}
+
+
+def scale_thresholds(scale=1, calibration=None):
+    """
+    Return (thresh, MinZero) for evaluating blur at a scale.
+
+    The defaults from the paper apply to full resolution images, reduced
+    scales fall back to them only if they have not been calibrated.
+    """
+    thresholds = (calibration or {}).get(scale)
+    if thresholds is None:
+        if scale != 1:
+            print('No blur calibration for scale', scale, 'using full resolution thresholds.')
+        return DEFAULT_THRESH, DEFAULT_MIN_ZERO
+    return thresholds['thresh'], thresholds['MinZero']
+
+
+def blur_detect_reference(image=None, thresh=35, MinZero=0.05):
+    """
+    The original loop implementation of blur_detect.
+
+    Kept to check that blur_detect returns identical values, see compare().
+    """
+    image = load_image(image)
+
     x_cropped = image[0:(int(numpy.shape(image)[0]/16)*16 - 1), 0:(int(numpy.shape(image)[1]/16)*16 - 1)]
 
     LL1,(LH1,HL1,HH1) = pywt.dwt2(x_cropped,'haar')
@@ -105,10 +341,108 @@ def blur_detect(image=None, thresh=35, MinZero=0.05):
         #print ('Blurred')
         return True, per, BlurExtent
 
+
+def compare(image_paths=None, thresh=35, MinZero=0.05):
+    """
+    Check blur_detect against blur_detect_reference and time both.
+
+    Returns
+    -------
+    bool
+        True if every image gives identical per and BlurExtent values.
+    """
+    identical = True
+    for image_path in image_paths:
+        image = load_image(image_path)
+        start_time = time.perf_counter()
+        try:
+            reference = blur_detect_reference(image=image, thresh=thresh, MinZero=MinZero)
+        except ZeroDivisionError:
+            reference = 'ZeroDivisionError'
+        reference_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        try:
+            result = blur_detect(image=image, thresh=thresh, MinZero=MinZero)
+        except ZeroDivisionError:
+            result = 'ZeroDivisionError'
+        result_time = time.perf_counter() - start_time
+        match = result == reference
+        identical = identical and match
+        print(image_path, 'identical' if match else 'DIFFERENT', result, reference)
+        print(f'    loops: {reference_time:.3f}s vectorized: {result_time:.3f}s')
+    return identical
+
+
+def synthetic_images(seed=0, width=640, height=480):
+    """
+    Return a seeded sharp test image and blurred versions of it as 8 bit arrays.
+
+    The sharp image is random rectangles on a noisy background, the blurred
+    versions are Gaussian blurs of it with increasing radius.
+    """
+    random = numpy.random.RandomState(seed)
+    pixels = random.randint(96, 160, size=(height, width)).astype(numpy.float32)
+    for _ in range(60):
+        top, left = random.randint(0, height - 8), random.randint(0, width - 8)
+        pixels[top:top + random.randint(8, 120), left:left + random.randint(8, 160)] = random.randint(0, 256)
+    sharp = numpy.clip(pixels + random.normal(0, 4, size=pixels.shape), 0, 255).astype(numpy.uint8)
+    images = [sharp]
+    for radius in [1, 3, 6]:
+        images.append(numpy.asarray(Image.fromarray(sharp).filter(ImageFilter.GaussianBlur(radius))))
+    return images
+
+
+def self_check(seed=0):
+    """
+    Check blur_detect, its tiled path and blur_detect_reference agree on synthetic images.
+
+    The tiled path is also compared with blur_detect for a synthetic JPEG file.
+
+    Does not need sample images, unlike compare.
+
+    Returns
+    -------
+    bool
+        True if all three give identical results for every image.
+    """
+    identical = True
+    for index, pixels in enumerate(synthetic_images(seed=seed)):
+        image = pixels.astype(numpy.float32)
+        results = []
+        for evaluate in [lambda: blur_detect_reference(image=image),
+                         lambda: blur_detect(image=image),
+                         # a small budget splits the image into several strips
+                         lambda: blur_detect(image=pixels, memory_budget=256 * 1024)]:
+            try:
+                results.append(evaluate())
+            except ZeroDivisionError:
+                results.append('ZeroDivisionError')
+        match = results[0] == results[1] == results[2]
+        identical = identical and match
+        print('synthetic image', index, 'identical' if match else 'DIFFERENT', *results)
+    # files are decoded once and converted by strips in the tiled path, check it matches for a color JPEG
+    images = synthetic_images(seed=seed)
+    with tempfile.TemporaryDirectory() as directory:
+        jpeg_path = os.path.join(directory, 'synthetic.jpg')
+        Image.fromarray(numpy.stack([images[1], images[0], images[2]], axis=-1)).save(jpeg_path, quality=90)
+        for scale in [1, 2]:
+            results = [blur_detect(image=jpeg_path, scale=scale),
+                       blur_detect(image=jpeg_path, scale=scale, memory_budget=256 * 1024)]
+            match = results[0] == results[1]
+            identical = identical and match
+            print('synthetic JPEG scale', scale, 'identical' if match else 'DIFFERENT', *results)
+    return identical
+
+
 if __name__=='__main__':
+    if sys.argv[1] == '--compare':
+        # python blur_detection.py --compare image.jpg [image.jpg ...]
+        sys.exit(0 if compare(image_paths=sys.argv[2:]) else 1)
+    if sys.argv[1] == '--self-check':
+        # python blur_detection.py --self-check
+        sys.exit(0 if self_check() else 1)
     is_blurry, per, blur_extent = blur_detect(image=sys.argv[1])
     if is_blurry:
         print('Blurry:', per, blur_extent)
     else:
         print('Not blurry:', per, blur_extent)
-
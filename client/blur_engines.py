@@ -0,0 +1,200 @@
+"""Blur evaluation engines selected by the BLUR section of config_local.ini."""
+
+import logging
+
+import numpy
+from PIL import Image
+
+import utilities
+
+BLUR_LOGGER = logging.getLogger('session_log')
+DEFAULT_ENGINE = 'haar'
+DEFAULT_LAPLACIAN_THRESHOLD = 100.0  # variance of the Laplacian of 8 bit grayscale images
+DEFAULT_LAPLACIAN_SCALE = 2
+
+
+class BlurEngine():
+    """
+    Interface of a blur engine.
+
+    evaluate returns (is_blurry, blurriness). The meaning of blurriness
+    depends on the engine, it is stored with the image event as reported.
+    Engines hold only plain settings, so they can be pickled for process pools.
+    """
+
+    name = None
+
+    def evaluate(self, image=None, cache=None):
+        """
+        Evaluate an image.
+
+        Parameters
+        ----------
+        image : string or numpy.ndarray
+            Image path or grayscale array.
+        cache : processing_cache.ProcessingCache
+
+        Returns
+        -------
+        tuple
+            (is_blurry, blurriness)
+        """
+        raise NotImplementedError
+
+
+class HaarEngine(BlurEngine):
+    """
+    Tong et al. Haar wavelet method, see blur_detection.
+
+    blurriness is BlurExtent. pywt is only imported when the engine is created.
+    """
+
+    name = 'haar'
+
+    def __init__(self, scale=1, thresh=None, MinZero=None, calibration_path=None, memory_budget=None):
+        import blur_detection  # imports pywt
+        if scale not in blur_detection.BLUR_SCALES:
+            print('Unsupported blur scale:', scale)
+            BLUR_LOGGER.error('Unsupported blur scale: ' + str(scale) + ', using 1.')
+            scale = 1
+        calibration = {}
+        if scale != 1 and calibration_path:
+            calibration = blur_detection.load_calibration(calibration_path)
+        calibrated_thresh, calibrated_min_zero = blur_detection.scale_thresholds(scale, calibration)
+        self.scale = scale
+        self.thresh = calibrated_thresh if thresh is None else thresh
+        self.MinZero = calibrated_min_zero if MinZero is None else MinZero
+        self.memory_budget = memory_budget  # bytes, evaluates large images in strips
+
+    def evaluate(self, image=None, cache=None):
+        import blur_detection
+        is_blurry, per, blur_extent = blur_detection.blur_detect(image=image, thresh=self.thresh, MinZero=self.MinZero,
+                                                                 cache=cache, scale=self.scale,
+                                                                 memory_budget=self.memory_budget)
+        return is_blurry, blur_extent
+
+
+class LaplacianEngine(BlurEngine):
+    """
+    Variance of the Laplacian, in numpy.
+
+    A sharp image has strong second derivatives at its edges, so a low
+    variance indicates blur. blurriness is the variance, lower is blurrier.
+    Much cheaper than the Haar method but the threshold depends on the
+    subject and lighting, compare engines with blur_benchmark.py.
+
+    Parameters
+    ----------
+    threshold : float
+        Images with a variance below threshold are blurry.
+    scale : int
+        Evaluate the image reduced by scale, JPEGs are reduced while decoding.
+    region : list
+        Normalized [left, top, right, bottom] box evaluated, e.g. the specimen
+        area excluding the color bar and label. Default is the whole frame.
+    """
+
+    name = 'laplacian'
+
+    def __init__(self, threshold=DEFAULT_LAPLACIAN_THRESHOLD, scale=DEFAULT_LAPLACIAN_SCALE, region=None):
+        self.threshold = threshold
+        self.scale = scale
+        self.region = region
+
+    def evaluate(self, image=None, cache=None):
+        if cache is not None and type(image) is str:
+            found, result = cache.lookup(file_path=image, name=self.cache_name())
+            if found:
+                return tuple(result)
+            result = self.evaluate(image=image)
+            cache.store(file_path=image, name=self.cache_name(), value=list(result))
+            return result
+
+        if type(image) is str:
+            image = numpy.asarray(utilities.reduced_image(file_path=image, scale=self.scale, mode='L'),
+                                  dtype=numpy.float32)
+        elif self.scale > 1:
+            image = Image.fromarray(numpy.asarray(image, dtype=numpy.float32))
+            image = numpy.asarray(utilities.reduce_image(image, self.scale))
+        if self.region is not None:
+            height, width = image.shape
+            image = image[int(self.region[1] * height):int(self.region[3] * height),
+                          int(self.region[0] * width):int(self.region[2] * width)]
+        variance = laplacian_variance(image)
+        return bool(variance < self.threshold), variance
+
+    def cache_name(self):
+        return 'laplacian:' + str(self.threshold) + ':' + str(self.scale) + ':' + str(self.region)
+
+
+def laplacian_variance(image=None):
+    """Return the variance of the 4-neighbour Laplacian of a grayscale array."""
+    image = numpy.asarray(image, dtype=numpy.float32)
+    if image.shape[0] < 3 or image.shape[1] < 3:
+        return 0.0
+    laplacian = (image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:]
+                 - 4 * image[1:-1, 1:-1])
+    return float(laplacian.var(dtype=numpy.float64))
+
+
+# engine name: BlurEngine subclass
+ENGINES = {HaarEngine.name: HaarEngine, LaplacianEngine.name: LaplacianEngine}
+
+
+def register_engine(engine_class=None):
+    """Add a BlurEngine subclass to the engines available in config."""
+    ENGINES[engine_class.name] = engine_class
+    return engine_class
+
+
+def create_engine(name=DEFAULT_ENGINE, **options):
+    """Create a registered engine, None if the name is unknown."""
+    engine_class = ENGINES.get(name)
+    if engine_class is None:
+        print('Unknown blur engine:', name)
+        BLUR_LOGGER.error('Unknown blur engine: ' + str(name) + ', available: ' + ', '.join(sorted(ENGINES)))
+        return None
+    return engine_class(**options)
+
+
+def engine_from_config(config_local=None):
+    """
+    Create the blur engine set in the BLUR section of config_local.
+
+    Options: engine (haar or laplacian), scale, calibration and memory_budget
+    (haar, in MB), threshold and region (laplacian, region as left, top, right, bottom).
+    """
+    name = config_local.get('BLUR', 'engine', fallback=DEFAULT_ENGINE)
+    if name == LaplacianEngine.name:
+        region = parse_region(config_local.get('BLUR', 'region', fallback=None))
+        engine = create_engine(name, threshold=config_local.getfloat('BLUR', 'threshold',
+                                                                     fallback=DEFAULT_LAPLACIAN_THRESHOLD),
+                               scale=config_local.getint('BLUR', 'scale', fallback=DEFAULT_LAPLACIAN_SCALE),
+                               region=region)
+    elif name == HaarEngine.name:
+        memory_budget = config_local.getint('BLUR', 'memory_budget', fallback=0) * 1024 * 1024
+        engine = create_engine(name, scale=config_local.getint('BLUR', 'scale', fallback=1),
+                               calibration_path=config_local.get('BLUR', 'calibration', fallback=None),
+                               memory_budget=memory_budget or None)
+    else:
+        engine = create_engine(name)
+    if engine is None:
+        engine = create_engine(DEFAULT_ENGINE)
+    return engine
+
+
+def parse_region(region=None):
+    """Parse a normalized 'left, top, right, bottom' box, None if not set or invalid."""
+    if not region:
+        return None
+    try:
+        left, top, right, bottom = [float(value) for value in region.replace(',', ' ').split()]
+    except ValueError:
+        print('Invalid blur region:', region)
+        BLUR_LOGGER.error('Invalid blur region: ' + region)
+        return None
+    if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+        print('Invalid blur region:', region)
+        BLUR_LOGGER.error('Invalid blur region: ' + region)
+        return None
+    return [left, top, right, bottom]
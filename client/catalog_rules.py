@@ -0,0 +1,137 @@
+"""Rules deriving catalog numbers from barcode values."""
+
+import configparser
+import logging
+import re
+
+import utilities
+
+RULES_LOGGER = logging.getLogger('session_log')
+DEFAULT_PATTERNS = [r'BRIT\d+$', r'NLU\d+$', r'ANHC\d+$', r'UARK\d+$', r'\d+$']
+DEFAULT_PREFIX = ''  # This will be prepended to the selected catalog_number if it doesn't exist
+MEMO_SIZE = 10000  # barcode values remembered by CatalogNumberRules.classify
+LEADING_ZEROS = re.compile(r'^(\D*)0+(?=\d)')
+
+
+class CatalogNumberRules():
+    """
+    Compiled catalog number rules.
+
+    All patterns are compiled once into a single alternation, tried from the
+    start of the barcode value in the configured order. Barcode rules applied:
+    leading zeros stripped (optional)
+    prefix prepended
+    values matching preferred_patterns selected first, in preference order
+    barcodes sorted
+    lowest value selected
+
+    The result for each barcode value is memoized, instances can be pickled
+    for process pools.
+    """
+
+    def __init__(self, patterns=None, prefix=DEFAULT_PREFIX, strip_leading_zeros=False, preferred_patterns=None):
+        if patterns is None:
+            patterns = DEFAULT_PATTERNS
+        self.patterns = list(patterns)
+        self.prefix = prefix or ''
+        self.strip_leading_zeros = strip_leading_zeros
+        self.preferred_patterns = list(preferred_patterns or [])
+        self.regex = re.compile('|'.join('(?P<p' + str(index) + '>' + pattern + ')'
+                                         for index, pattern in enumerate(self.patterns)))
+        # pattern group name: rank, lower ranks are selected first
+        self.ranks = {}
+        for index, pattern in enumerate(self.patterns):
+            if pattern in self.preferred_patterns:
+                self.ranks['p' + str(index)] = self.preferred_patterns.index(pattern)
+            else:
+                self.ranks['p' + str(index)] = len(self.preferred_patterns)
+        self.memo = {}
+
+    def classify(self, candidate=None):
+        """
+        Standardize a barcode value.
+
+        Returns
+        -------
+        tuple
+            (catalog number, rank), catalog number is None if no pattern matches.
+        """
+        candidate = str(candidate).strip()
+        result = self.memo.get(candidate)
+        if result is None:
+            m = self.regex.match(candidate)
+            if m:
+                catalog_number = m.group()
+                if self.strip_leading_zeros:
+                    catalog_number = LEADING_ZEROS.sub(r'\1', catalog_number)
+                if not catalog_number.startswith(self.prefix):
+                    catalog_number = self.prefix + catalog_number
+                result = (catalog_number, self.ranks[m.lastgroup])
+            else:
+                result = (None, None)
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo.clear()
+            self.memo[candidate] = result
+        return result
+
+    def derive(self, candidates=None):
+        """
+        Generate valid catalog numbers from barcode values.
+
+        Returns
+        -------
+        tuple
+            (canonical catalog number or None, list of the other valid catalog numbers)
+        """
+        matches = {}
+        for candidate in candidates or []:
+            catalog_number, rank = self.classify(candidate)
+            if catalog_number is not None:
+                matches[catalog_number] = min(rank, matches.get(catalog_number, rank))
+        if not matches:
+            return None, []
+        sorted_catalog_numbers = sorted(matches, key=lambda catalog_number: (matches[catalog_number],
+                                                                             utilities.alphanum_key(catalog_number)))
+        return sorted_catalog_numbers[0], sorted_catalog_numbers[1:]
+
+    def has_catalog_number(self, barcodes_list=None):
+        """Return True if any barcode dict holds a valid catalog number, used as a utilities.barcodes validator."""
+        for barcode_record in barcodes_list or []:
+            if self.classify(barcode_record['data'])[0] is not None:
+                return True
+        return False
+
+
+def rules_from_config(*configs):
+    """
+    Create CatalogNumberRules from the CATALOG_NUMBERS section of config files.
+
+    Later configs override earlier ones, e.g. rules_from_config(config, config_local).
+    patterns and preferred_patterns are given one per line.
+    """
+    options = {}
+    for config in configs:
+        if config.has_section('CATALOG_NUMBERS'):
+            options.update(config.items('CATALOG_NUMBERS'))
+    patterns = split_lines(options.get('patterns')) or None
+    try:
+        strip_leading_zeros = configparser.ConfigParser.BOOLEAN_STATES[options.get('strip_leading_zeros', 'false').lower()]
+    except KeyError:
+        print('Invalid strip_leading_zeros value:', options.get('strip_leading_zeros'))
+        RULES_LOGGER.error('Invalid strip_leading_zeros value: ' + str(options.get('strip_leading_zeros')))
+        strip_leading_zeros = False
+    try:
+        return CatalogNumberRules(patterns=patterns, prefix=options.get('prefix', DEFAULT_PREFIX),
+                                  strip_leading_zeros=strip_leading_zeros,
+                                  preferred_patterns=split_lines(options.get('preferred_patterns')))
+    except re.error as e:
+        print('Invalid catalog number pattern, using defaults:', e)
+        RULES_LOGGER.exception('Invalid catalog number pattern, using defaults.')
+        return CatalogNumberRules()
+
+
+def split_lines(value=None):
+    """Split a multi-line config value into a list of non-empty lines."""
+    if not value:
+        return []
+    return [line.strip() for line in value.splitlines() if line.strip()]
@@ -1,16 +1,23 @@
 # from argparse import ArgumentParser
 import atexit
+import concurrent.futures
 import configparser
 import datetime
-import json
 import logging
 import os
-import re
+import threading
 import time
 import uuid
 
 import utilities
-import blur_detection
+import barcode_region
+import blur_engines
+import catalog_rules
+import hashing
+import journal
+import pipeline
+import processing_cache
+import rename_plan
 
 import click
 from watchdog.events import PatternMatchingEventHandler
@@ -19,11 +26,11 @@ from watchdog.observers import Observer
 RAW_IMAGE_PATTERNS = ['*.cr2', '*.CR2']  # use later to detect original creation of raw files
 DERIVED_IMAGE_PATTERNS = ['*.jpg', '*.JPG']
 IMAGE_PATTERNS = RAW_IMAGE_PATTERNS + DERIVED_IMAGE_PATTERNS
-valid_catalog_number_patterns = ['BRIT\d+$', 'NLU\d+$', 'ANHC\d+$', 'UARK\d+$', '\d+$']
-REQUIRED_CATALOG_NUMBER_PREFIX = ''  # This will be prepended to the selected catalog_number if it doesn't exist
+# Replaced by the station's configured rules when the Client is created
+CATALOG_NUMBER_RULES = catalog_rules.CatalogNumberRules()
 SESSION_LOGGER = logging.getLogger('session_log')
 config_local_path = 'config_local.ini'
-# config_path = 'config.ini'
+config_path = 'config.ini'  # settings shared between imaging stations
 
 
 class Client():
@@ -39,6 +46,10 @@ class Client():
 
     def __init__(self, client_ui=None):
         """Initialize client values."""
+        global CATALOG_NUMBER_RULES
+        # Load shared config, settings in config_local override it
+        config = configparser.ConfigParser(allow_no_value=True)
+        config.read(config_path)
         # Load config_local
         config_local = configparser.ConfigParser(allow_no_value=True)
         config_local.read(config_local_path)
@@ -52,6 +63,38 @@ class Client():
             station_id = None
         self.station_uuid = station_uuid
         self.station_id = station_id
+        # Ingest pipeline settings
+        self.ingest_workers = config_local.getint('INGEST', 'workers', fallback=None)
+        self.ingest_executor = config_local.get('INGEST', 'executor', fallback=pipeline.DEFAULT_EXECUTOR_TYPE)
+        self.evaluate_blur = config_local.getboolean('INGEST', 'evaluate_blur', fallback=True)
+        self.blur_workers = config_local.getint('INGEST', 'blur_workers', fallback=None)
+        self.settle_time = config_local.getfloat('INGEST', 'settle_time', fallback=pipeline.DEFAULT_SETTLE_TIME)
+        self.use_processing_cache = config_local.getboolean('INGEST', 'processing_cache', fallback=True)
+        # Rename files as soon as an image event is complete instead of at the end of the session
+        self.rename_immediately = config_local.getboolean('INGEST', 'rename_immediately', fallback=False)
+        # Blur engine and its settings, see blur_engines.engine_from_config
+        self.blur_engine = blur_engines.engine_from_config(config_local)
+        # Digests of raw files stored for archive fixity checks, in addition to md5
+        self.fixity_digests = hashing.parse_algorithms(config_local.get('INGEST', 'fixity_digests', fallback=None))
+        self.journal_flush_every = config_local.getint('JOURNAL', 'flush_every', fallback=journal.DEFAULT_FLUSH_EVERY)
+        self.journal_flush_interval = config_local.getfloat('JOURNAL', 'flush_interval',
+                                                           fallback=journal.DEFAULT_FLUSH_INTERVAL)
+        self.journal_fsync = config_local.getboolean('JOURNAL', 'fsync', fallback=True)
+        # Where this station's catalog number barcodes are usually found
+        if config_local.getboolean('BARCODES', 'learn_region', fallback=True):
+            self.barcode_region = barcode_region.BarcodeRegion(barcode_region.region_path(self.station_uuid))
+        else:
+            self.barcode_region = None
+        # Only these symbologies are decoded, all symbologies if not set
+        accepted_barcode_symbologies = config.get('BARCODES', 'accepted_barcode_symbologies', fallback=None)
+        accepted_barcode_symbologies = config_local.get('BARCODES', 'accepted_barcode_symbologies',
+                                                        fallback=accepted_barcode_symbologies)
+        self.barcode_symbologies = utilities.parse_symbologies(accepted_barcode_symbologies)
+        # Catalog number patterns, prefix and normalization
+        self.catalog_number_rules = catalog_rules.rules_from_config(config, config_local)
+        CATALOG_NUMBER_RULES = self.catalog_number_rules
+        # Read barcodes from the JPEG preview embedded in raw files
+        self.read_raw_preview = config_local.getboolean('BARCODES', 'read_raw_preview', fallback=True)
         # Client can only have one active session at at time.
         self.session = None
         self.client_ui = client_ui
@@ -80,9 +123,29 @@ class Session():
         self.collection_code = None
         self.username = None
         self.image_events = []
+        # Indexes of image_events, maintained by register_image_event
+        self.events_by_filename = {}
+        self.events_by_id = {}
+        self.events_by_catalog_number = {}
+        self.indexed_catalog_numbers = {}  # event id: catalog_number key used in events_by_catalog_number
         self.start_time = None
         self.notes = None
         self.taxa = None
+        # Serializes merging of pipeline results into image_events
+        self.lock = threading.RLock()
+        self.pipeline = None
+        self.write_monitor = None
+        self.processing_cache = None
+        self.journal = None
+        self.journaled_states = {}  # event id: values at the last journal record
+        # Immediate rename mode
+        self.rename_executor = None
+        self.rename_scheduled = set()  # ids of events queued for renaming
+        self.renamed_paths = set()  # normcased paths created by renaming, ignored by the watcher
+        self.rename_listings = {}  # folder listings kept between the renames of single events
+        self.blur_evaluated = set()  # normcased derived image paths evaluated by blur QC
+        self.serialized_states = {}  # event id: values written to the event JSON file during the session
+        self.ending = False  # set once the pipeline is stopped, files reported afterwards are not registered
         # TODO move client_ui to Client class
         # make it work with both CLI and GUI
         self.client_ui = client_ui
@@ -102,6 +165,8 @@ class Session():
             # TODO make sure path is valid and writable
             self.start_time = datetime.datetime.now()
             print('Started monitoring of:', self.path, self.start_time)
+            self.open_journal()
+            self.start_pipeline()
             # start watching session folder for file additions and changes
             event_handler = ImageHandler(session=self, patterns=IMAGE_PATTERNS)
             # event_handler = ImageHandler(patterns=IMAGE_PATTERNS)
@@ -118,6 +183,238 @@ class Session():
         else:
             print('No path to monitor.')
 
+    def open_journal(self):
+        """Open the append-only journal that records image event changes in the session folder."""
+        if self.journal is None and self.path:
+            journal_path = os.path.join(self.path, self.uuid + journal.JOURNAL_EXTENSION)
+            if self.client_instance:
+                self.journal = journal.SessionJournal(journal_path,
+                                                      flush_every=self.client_instance.journal_flush_every,
+                                                      flush_interval=self.client_instance.journal_flush_interval,
+                                                      fsync=self.client_instance.journal_fsync)
+            else:
+                self.journal = journal.SessionJournal(journal_path)
+            start_time = self.start_time.isoformat() if self.start_time else None
+            self.journal.record(op='session', record_id=self.uuid,
+                                data={'uuid': self.uuid, 'path': self.path, 'username': self.username,
+                                      'collection_code': self.collection_code, 'project_code': self.project_code,
+                                      'notes': self.notes, 'taxa': self.taxa, 'start_time': start_time})
+        return self.journal
+
+    def close_journal(self):
+        """Close the journal and write the final JSON file of each image event."""
+        if self.journal is not None:
+            self.journal.close()
+            # JSON files written when the event's files were renamed are still current
+            unchanged_event_ids = [event_id for event_id, state in self.serialized_states.items()
+                                   if self.events_by_id[event_id].__dict__ == state]
+            journal.compact_journal(self.journal.path, output_directory=self.path,
+                                    skip_event_ids=unchanged_event_ids)
+            self.journal = None
+
+    def record_image_event(self, image_event=None):
+        """Write the values of an image event that changed since its last record to the journal."""
+        if self.journal is None:
+            return
+        state = dict(image_event.__dict__)
+        previous_state = self.journaled_states.get(image_event.id)
+        if previous_state is None:
+            self.journal.record(op='create', record_id=image_event.id, data=state)
+        else:
+            delta = {key: value for key, value in state.items()
+                     if key not in previous_state or previous_state[key] != value}
+            if delta:
+                self.journal.record(op='update', record_id=image_event.id, data=delta)
+        self.journaled_states[image_event.id] = state
+
+    def rename_image_files(self):
+        """
+        Rename the image files of all events using their catalog numbers.
+
+        The renames are planned from a single listing of the session folder and
+        run as one transaction, see rename_plan.RenamePlan. The new paths are
+        recorded in the journal.
+
+        Returns
+        -------
+        bool
+            True if all planned files were renamed.
+        """
+        with self.lock:
+            plan = rename_plan.RenamePlan(self.image_events)
+            print('Renaming', len(plan.renames), 'image files.')
+            # the watcher is still running and reports the renamed files
+            for rename in plan.renames:
+                self.renamed_paths.add(os.path.normcase(rename['target']))
+            manifest_path = None
+            if self.path:
+                manifest_path = rename_plan.manifest_path(self.path, self.uuid)
+            renamed = plan.execute(manifest_path=manifest_path)
+            for image_event in self.image_events:
+                self.record_image_event(image_event)
+            return renamed
+
+    def resume(self, journal_path=None):
+        """
+        Restore a session that ended without end_session from its journal.
+
+        Session values and image_events are rebuilt from the journal (by default
+        the latest journal in the session folder), which is then reopened so new
+        records are appended. Call reconcile_directory once the pipeline is
+        started to pick up files the journal does not know about.
+
+        Returns
+        -------
+        bool
+            True if a journal was found and loaded.
+        """
+        if journal_path is None and self.path:
+            journal_path = journal.latest_journal(self.path)
+        if journal_path is None:
+            print('No session journal found in:', self.path)
+            SESSION_LOGGER.error('No session journal found to resume in: ' + str(self.path))
+            return False
+        session_data, events = journal.read_journal(journal_path)
+        self.uuid = session_data.get('uuid', self.uuid)
+        # Renames interrupted at the end of the session are not in the journal
+        if self.path:
+            rename_plan.recover(rename_plan.manifest_path(self.path, self.uuid))
+        for attribute in ['username', 'collection_code', 'project_code', 'notes', 'taxa']:
+            if getattr(self, attribute) is None:
+                setattr(self, attribute, session_data.get(attribute))
+        if session_data.get('start_time'):
+            self.start_time = parse_timestamp(session_data['start_time'])
+        with self.lock:
+            for event_id, event_data in events.items():
+                image_event = ImageEvent.from_record(event_data)
+                self.image_events.append(image_event)
+                self.index_image_event(image_event)
+                self.journaled_states[event_id] = dict(image_event.__dict__)
+                if self.client_ui:
+                    self.client_ui.add_event(event=image_event)
+        print('Resumed session', self.uuid, 'with', len(self.image_events), 'image events.')
+        SESSION_LOGGER.info('Resumed session ' + self.uuid + ' from journal: ' + journal_path)
+        self.open_journal()
+        return True
+
+    def reconcile_directory(self):
+        """
+        Register image files in the session folder that the journal does not know about.
+
+        A single scan of the folder: files already recorded in an image event are
+        not processed again. Files renamed by an interrupted end of session are
+        matched back to their event by catalog number.
+        """
+        known_paths = set()
+        renamed_paths = {}  # expected path after renaming: (event, 'raw' or 'derived')
+        for image_event in self.image_events:
+            for image_path in [image_event.original_raw_image, image_event.new_raw_image,
+                               image_event.original_derived_image, image_event.new_derived_image]:
+                if image_path:
+                    known_paths.add(os.path.normcase(image_path))
+            if image_event.catalog_number:
+                for original_path, kind in [(image_event.original_raw_image, 'raw'),
+                                            (image_event.original_derived_image, 'derived')]:
+                    if original_path and not os.path.exists(original_path):
+                        directory, basename = os.path.split(original_path)
+                        extension = os.path.splitext(basename)[1]
+                        for name in [image_event.catalog_number + extension,
+                                     image_event.catalog_number + '_' + image_event.id + extension]:
+                            renamed_paths[os.path.normcase(os.path.join(directory, name))] = (image_event, kind)
+        new_file_count = 0
+        for entry in pipeline.scan_image_files(self.path):
+            image_path = os.path.normcase(entry.path)
+            if image_path in known_paths:
+                continue
+            if image_path in renamed_paths:
+                image_event, kind = renamed_paths.pop(image_path)
+                with self.lock:
+                    if kind == 'raw':
+                        image_event.new_raw_image = entry.path
+                    else:
+                        image_event.new_derived_image = entry.path
+                    self.record_image_event(image_event)
+                continue
+            new_file_count += 1
+            self.submit_image(image_path=entry.path, closed=True)
+        SESSION_LOGGER.info('Reconciled session folder, ' + str(new_file_count) + ' new image files.')
+        return new_file_count
+
+    def start_pipeline(self):
+        """Start the worker pool that processes files reported by the watcher."""
+        if self.pipeline is None:
+            # Results for unchanged files are reused when a session folder is reopened
+            if self.path and (self.client_instance is None or self.client_instance.use_processing_cache):
+                self.processing_cache = processing_cache.ProcessingCache(
+                    os.path.join(self.path, processing_cache.CACHE_FILENAME))
+            if self.client_instance:
+                self.pipeline = pipeline.IngestPipeline(session=self,
+                                                        workers=self.client_instance.ingest_workers,
+                                                        executor_type=self.client_instance.ingest_executor,
+                                                        evaluate_blur=self.client_instance.evaluate_blur,
+                                                        cache=self.processing_cache,
+                                                        barcode_region=self.client_instance.barcode_region,
+                                                        symbologies=self.client_instance.barcode_symbologies,
+                                                        read_raw_preview=self.client_instance.read_raw_preview,
+                                                        catalog_number_rules=self.client_instance.catalog_number_rules,
+                                                        fixity_digests=self.client_instance.fixity_digests,
+                                                        blur_engine=self.client_instance.blur_engine,
+                                                        blur_workers=self.client_instance.blur_workers)
+                settle_time = self.client_instance.settle_time
+            else:
+                self.pipeline = pipeline.IngestPipeline(session=self, cache=self.processing_cache)
+                settle_time = pipeline.DEFAULT_SETTLE_TIME
+            if self.client_instance and self.client_instance.rename_immediately:
+                # Renames run one at a time, in the order events become complete
+                self.rename_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            # Files are only handed to the pipeline once they are completely written
+            self.write_monitor = pipeline.WriteCompletionMonitor(submit=self.pipeline.submit, settle_time=settle_time)
+        return self.pipeline
+
+    def stop_pipeline(self):
+        """Wait for queued files to be processed and stop the worker pool."""
+        self.ending = True
+        if self.write_monitor is not None:
+            self.write_monitor.stop()
+            self.write_monitor = None
+        if self.pipeline is not None:
+            self.pipeline.shutdown(wait=True)
+            self.pipeline = None
+        # after the pipeline, whose results may still queue renames
+        if self.rename_executor is not None:
+            self.rename_executor.shutdown(wait=True)
+            self.rename_executor = None
+        if self.processing_cache is not None:
+            self.processing_cache.close()
+            self.processing_cache = None
+        if self.client_instance and self.client_instance.barcode_region is not None:
+            self.client_instance.barcode_region.save()
+
+    def submit_image(self, image_path=None, closed=False):
+        """
+        Queue an image file for processing, or register it inline without a pipeline.
+
+        The file is processed once it is completely written, closed indicates
+        the writer has already closed the file. Files reported once the session
+        is ending are ignored.
+        """
+        if image_path is not None and os.path.normcase(image_path) in self.renamed_paths:
+            # Reported by the watcher for a file this session renamed
+            SESSION_LOGGER.info('Ignoring event for renamed file: ' + image_path)
+            return
+        if self.ending:
+            SESSION_LOGGER.warning('Session ending, not registering: ' + str(image_path))
+            return
+        # stop_pipeline may clear write_monitor from another thread
+        write_monitor = self.write_monitor
+        if write_monitor is not None:
+            if closed:
+                write_monitor.file_closed(image_path=image_path)
+            else:
+                write_monitor.notify(image_path=image_path)
+        else:
+            self.register_image_event(image_path=image_path)
+
     def elapsed_time(self):
         """Return the time elapsed since the session was started."""
         if self.start_time:
@@ -138,7 +435,7 @@ class Session():
         else:
             return None
 
-    def register_image_event(self, image_path=None):
+    def register_image_event(self, image_path=None, file_metadata=None):
         """
         Create an image event or add image file to existing event.
 
@@ -151,11 +448,17 @@ class Session():
         Parameters
         ----------
         image_path: string
+        file_metadata: dict
+            Values already computed by the ingest pipeline for image_path.
 
         Returns
         -------
         ImageEvent
         """
+        with self.lock:
+            return self._register_image_event(image_path=image_path, file_metadata=file_metadata)
+
+    def _register_image_event(self, image_path=None, file_metadata=None):
         if image_path is not None:
             # search for existing image event with matching image filename
             basename = os.path.basename(image_path)
@@ -183,26 +486,157 @@ class Session():
                 # TODO save any updates to event JSON file
                 # Instead of above steps, trying just update_image_event to consolidate code.
                 # This will populate file metadata for each
-                existing_event.update_image_event(original_image_path=image_path)
+                existing_event.update_image_event(original_image_path=image_path, file_metadata=file_metadata)
+                self.learn_barcode_region(existing_event, file_extension)
+                self.index_image_event(existing_event)
+                self.record_image_event(existing_event)
+                # Refresh client GUI with merged values
+                if self.client_ui:
+                    self.client_ui.update_event(event=existing_event)
+                self.schedule_rename(existing_event)
                 return existing_event
             # Matching event has not been registered
             # Create a new event
             else:
-                new_image_event = ImageEvent(session=self, original_image_path=image_path)
+                new_image_event = ImageEvent(session=self, original_image_path=image_path, file_metadata=file_metadata)
                 print('Creating new image event based on : ' + basename)
                 SESSION_LOGGER.info('Created new image event: ' + new_image_event.id + ' based on file: ' + basename)
                 # Add image_event to session
                 self.image_events.append(new_image_event)
+                self.learn_barcode_region(new_image_event, file_extension)
+                self.index_image_event(new_image_event)
                 # Add image event to client GUI
                 if self.client_ui:
                     self.client_ui.add_event(event=new_image_event)
+                # Recorded after the GUI adds its session values and sequence
+                self.record_image_event(new_image_event)
                 return new_image_event
 
+    def register_blur_result(self, image_path=None, blur_result=None):
+        """
+        Record the blurriness of a derived image evaluated by the blur QC pool.
+
+        The event status is updated, recorded in the journal and shown in the GUI.
+        """
+        with self.lock:
+            filename, file_extension = os.path.splitext(os.path.basename(image_path))
+            image_event = self.matching_image_event(filename)
+            if image_event is None or image_path not in (image_event.original_derived_image,
+                                                         image_event.new_derived_image):
+                SESSION_LOGGER.warning('No image event for blur result: ' + str(image_path))
+                return None
+            # Evaluated, even if unsuccessfully, so the files can be renamed
+            self.blur_evaluated.add(os.path.normcase(image_path))
+            if 'is_blurry' not in blur_result:
+                self.schedule_rename(image_event)
+                return None
+            image_event.is_blurry = blur_result['is_blurry']
+            image_event.blurriness = blur_result['blurriness']
+            image_event.blur_engine = blur_result['blur_engine']
+            image_event.update_image_event_status()
+            self.record_image_event(image_event)
+            if self.client_ui:
+                self.client_ui.update_event(event=image_event)
+            self.schedule_rename(image_event)
+            return image_event
+
+    def ready_to_rename(self, image_event=None):
+        """
+        Return True if the image files of an event can be renamed during the session.
+
+        The event needs a catalog number and both files, which are registered once
+        completely written. Blur QC reads the derived image, so it must be done.
+        """
+        if image_event.catalog_number is None:
+            return False
+        if image_event.original_raw_image is None or image_event.original_derived_image is None:
+            return False
+        if image_event.new_raw_image is not None or image_event.new_derived_image is not None:
+            return False
+        if self.pipeline is not None and self.pipeline.blur_executor is not None:
+            return os.path.normcase(image_event.original_derived_image) in self.blur_evaluated
+        return True
+
+    def schedule_rename(self, image_event=None):
+        """Queue the renaming of an event's files in immediate rename mode, once the event is ready."""
+        if self.rename_executor is None or image_event.id in self.rename_scheduled:
+            return
+        if self.ready_to_rename(image_event):
+            self.rename_scheduled.add(image_event.id)
+            self.rename_executor.submit(self.rename_event_files, image_event)
+
+    def rename_event_files(self, image_event=None):
+        """
+        Rename the files of a single event and write its JSON file.
+
+        Runs on the rename worker in immediate rename mode. Events are still
+        matched by original_filename, the new paths are ignored by the watcher.
+        """
+        try:
+            with self.lock:
+                self.rename_scheduled.discard(image_event.id)
+                if not self.ready_to_rename(image_event):
+                    return
+                # the session folder is listed once, not for every event
+                plan = rename_plan.RenamePlan([image_event], listings=self.rename_listings)
+                for rename in plan.renames:
+                    self.renamed_paths.add(os.path.normcase(rename['target']))
+                if not plan.execute():
+                    # the listing has the planned names, list the folder again
+                    self.rename_listings.clear()
+                    return
+                self.record_image_event(image_event)
+                if self.path:
+                    journal.write_event_json(image_event.id, image_event.__dict__, self.path)
+                    self.serialized_states[image_event.id] = dict(image_event.__dict__)
+                if self.client_ui:
+                    self.client_ui.update_event(event=image_event)
+        except Exception as e:
+            print('ERROR: unable to rename files of image event:', image_event.id, e)
+            SESSION_LOGGER.exception('Unable to rename files of image event: ' + image_event.id)
+
+    def learn_barcode_region(self, image_event=None, file_extension=None):
+        """Remember where the catalog number barcode was found in the image file just added."""
+        # Raw file barcodes come from its embedded preview, only used without a derived image
+        read_from_file = file_extension.upper() == '.JPG' or image_event.original_derived_image is None
+        if read_from_file and image_event.catalog_number is not None:
+            if self.client_instance and self.client_instance.barcode_region is not None:
+                self.client_instance.barcode_region.learn(image_event.catalog_number_barcodes())
+
+    def index_image_event(self, image_event=None):
+        """Add an image event to the lookup indexes or refresh its entries."""
+        self.events_by_id[image_event.id] = image_event
+        # First event registered for a filename is the one that gets paired
+        self.events_by_filename.setdefault(image_event.original_filename, image_event)
+        # catalog_number changes once the derived image has been read
+        indexed_catalog_number = self.indexed_catalog_numbers.get(image_event.id)
+        if indexed_catalog_number != image_event.catalog_number:
+            if indexed_catalog_number is not None:
+                self.events_by_catalog_number[indexed_catalog_number].remove(image_event)
+                if not self.events_by_catalog_number[indexed_catalog_number]:
+                    del self.events_by_catalog_number[indexed_catalog_number]
+            if image_event.catalog_number is not None:
+                self.events_by_catalog_number.setdefault(image_event.catalog_number, []).append(image_event)
+            self.indexed_catalog_numbers[image_event.id] = image_event.catalog_number
+
     def matching_image_event(self, filename=None):
-        for image_event in self.image_events:
-            if image_event.original_filename == filename:
-                return image_event
-        return None
+        """Return the image event registered for an original filename (without extension)."""
+        return self.events_by_filename.get(filename)
+
+    def has_derived_image(self, image_path=None):
+        """Return True if the image event of a file's original filename already has a derived image."""
+        filename = os.path.splitext(os.path.basename(image_path))[0]
+        with self.lock:
+            image_event = self.matching_image_event(filename)
+            return image_event is not None and image_event.original_derived_image is not None
+
+    def image_event_by_id(self, event_id=None):
+        """Return the image event with the given id."""
+        return self.events_by_id.get(event_id)
+
+    def image_events_by_catalog_number(self, catalog_number=None):
+        """Return the list of image events with the given catalog number."""
+        return list(self.events_by_catalog_number.get(catalog_number, []))
 
     def end_session(self):
         # TODO try registering cleanup for session variable so it happens after end_session
@@ -211,10 +645,10 @@ class Session():
         print('Session username: {}'.format(self.username))
         print('Session ID: {}'.format(self.uuid))
         print('Session path: {}'.format(self.path))
-        # print('Image event IDs:')
-        for event in self.image_events:
-            print(event.id, event.catalog_number)
-            event.rename_files()
+        self.stop_pipeline()
+        self.rename_image_files()
+        # Event JSON files are written once, from the journal
+        self.close_journal()
         #print('Completing final sync...STUB')
         # os.system("rsync -arz " + session['path'] + " /Users/jbest/Desktop/demo_shared")
         SESSION_LOGGER.info('Session monitor terminated.')
@@ -224,7 +658,7 @@ class ImageEvent():
     # TODO
     # consider using properties: https://stackoverflow.com/a/2825580/560798
 
-    def __init__(self, session=None, original_image_path=None):
+    def __init__(self, session=None, original_image_path=None, file_metadata=None):
         if session:
             # self.session = session
             self.session_uuid = session.uuid
@@ -263,25 +697,19 @@ class ImageEvent():
         self.other_catalog_numbers = None
         self.is_blurry = None
         self.blurriness = None
+        self.blur_engine = None  # blurriness values depend on the engine
         if original_image_path is not None:
             # update new image event metadata based on image file
-            self.update_image_event(original_image_path=original_image_path)
+            self.update_image_event(original_image_path=original_image_path, file_metadata=file_metadata)
         else:
             print('ERROR: missing original_image_path')
 
-    def evaluate_blurriness(self):
-        if self.original_derived_image:
-            #TODO file name might be changed before blur is evaluated
-            # test both original and new paths?
-            try:
-                is_blurry, per, blur_extent = blur_detection.blur_detect(self.original_derived_image)
-                self.is_blurry = is_blurry
-                self.blurriness = blur_extent
-                print('evaluate_blurriness:', is_blurry, blur_extent)
-            except Exception as e:
-                print('evaluate_blurriness: ERROR:', e)
-        else:
-            print('evaluate_blurriness: no self.original_derived_image')
+    @classmethod
+    def from_record(cls, record=None):
+        """Rebuild an image event from its recorded values without reading the image files."""
+        image_event = cls.__new__(cls)
+        image_event.__dict__.update(record)
+        return image_event
 
     def update_image_event_status(self):
         status = ''
@@ -310,49 +738,81 @@ class ImageEvent():
         self.status = status
         print('STATUS:', status)
 
-    def update_image_event(self, original_image_path=None):
+    def update_image_event(self, original_image_path=None, file_metadata=None):
+        """
+        Record an image file in the event.
+
+        file_metadata holds values already computed by the ingest pipeline,
+        if absent the file metadata is computed here.
+        """
         SESSION_LOGGER.info('Updating image event: ' + self.id)
         if original_image_path is not None:
             basename = os.path.basename(original_image_path)
             self.original_filename, file_extension = os.path.splitext(basename)
             if file_extension.upper() == '.CR2':
                 self.original_raw_image = original_image_path
-                self.populate_raw_metadata()
+                self.populate_raw_metadata(file_metadata=file_metadata)
             elif file_extension.upper() == '.JPG':
                 self.original_derived_image = original_image_path
-                self.populate_derived_metadata()
+                self.populate_derived_metadata(file_metadata=file_metadata)
             else:
                 print('ERROR: no matching file extension to generate image event.')
             self.update_image_event_status()
 
-    def populate_raw_metadata(self):
+    def populate_raw_metadata(self, file_metadata=None):
         if self.original_raw_image is not None:
-            self.raw_image_creation_date = utilities.creation_date(file_path=self.original_raw_image)
-            self.raw_image_md5hash = utilities.md5hash(file_path=self.original_raw_image)
+            if file_metadata is None:
+                file_metadata = pipeline.analyze_image_file(image_path=self.original_raw_image)
+            self.raw_image_creation_date = file_metadata.get('creation_date')
+            self.raw_image_md5hash = file_metadata.get('md5hash')
+            # e.g. raw_image_sha256hash
+            for algorithm, hexdigest in file_metadata.get('fixity', {}).items():
+                setattr(self, 'raw_image_' + algorithm + 'hash', hexdigest)
+            # Barcodes read from the embedded preview give an early catalog number,
+            # those read from the derived image take precedence.
+            if file_metadata.get('barcodes') and self.original_derived_image is None:
+                self.barcodes = file_metadata['barcodes']
+                self.derive_catalog_numbers_from_barcodes()
         else:
             print('ERROR, original_raw_image is None.')
 
-    def populate_derived_metadata(self):
+    def populate_derived_metadata(self, file_metadata=None):
         if self.original_derived_image is not None:
-            self.derived_image_md5hash = utilities.md5hash(file_path=self.original_derived_image)
+            if file_metadata is None:
+                file_metadata = pipeline.analyze_image_file(image_path=self.original_derived_image)
+            self.derived_image_md5hash = file_metadata.get('md5hash')
             # Read barcode values and symbologies from derived imaged
-            self.barcodes = utilities.barcodes(file_path=self.original_derived_image)
-            # Record barcodes for catalog_number and other_catalog_numbers
-            barcode_data_list = []
-            if self.barcodes:
-                for barcode_record in self.barcodes:
-                    barcode_data_list.append(barcode_record['data'])
-            if len(barcode_data_list) > 0:
-                self.catalog_number, self.other_catalog_numbers = derive_catalog_numbers(barcode_data_list)
-            else:
-                self.catalog_number = None
-                self.other_catalog_numbers = None
-                #print('WARNING - no barcode found.')
-            # evaluate blurriness
-            #self.evaluate_blurriness()
+            self.barcodes = file_metadata.get('barcodes')
+            self.derive_catalog_numbers_from_barcodes()
+            # blurriness is evaluated by the pipeline when enabled in config_local
+            if 'is_blurry' in file_metadata:
+                self.is_blurry = file_metadata['is_blurry']
+                self.blurriness = file_metadata['blurriness']
+                self.blur_engine = file_metadata.get('blur_engine')
         else:
             print('ERROR, original_derived_image is None.')
 
+    def derive_catalog_numbers_from_barcodes(self):
+        """Record barcodes for catalog_number and other_catalog_numbers."""
+        barcode_data_list = []
+        if self.barcodes:
+            for barcode_record in self.barcodes:
+                barcode_data_list.append(barcode_record['data'])
+        if len(barcode_data_list) > 0:
+            self.catalog_number, self.other_catalog_numbers = derive_catalog_numbers(barcode_data_list)
+        else:
+            self.catalog_number = None
+            self.other_catalog_numbers = None
+            #print('WARNING - no barcode found.')
+
+    def catalog_number_barcodes(self):
+        """Return the barcodes the catalog number was read from."""
+        catalog_number_barcodes = []
+        for barcode_record in getattr(self, 'barcodes', None) or []:
+            if derive_catalog_numbers([barcode_record['data']])[0] == self.catalog_number:
+                catalog_number_barcodes.append(barcode_record)
+        return catalog_number_barcodes
+
     def is_minimally_complete(self):
         """ Determines if the image_event is complete enough to serialize. """
         if hasattr(self, 'catalog_number'):
@@ -368,93 +828,31 @@ class ImageEvent():
         Save JSON record
         disabling test for minimal record
         may implement again if needed
+        Live sessions write JSON records from the session journal instead.
         """
         # if self.is_minimally_complete():
         if self.session_path:
             print('serialize_image_event:session_path', self.session_path)
-            # TODO - make sure catalog_number can be used in format_filename
-            catalog_number_string = self.catalog_number
-            if catalog_number_string:
-                #json_file_name = catalog_number_string + '_' + self.id + '.JSON'
-                json_file_name = catalog_number_string + '.JSON'
-            else:
-                json_file_name = self.original_filename + '_' + self.id + '.JSON'
-            json_path = os.path.join(self.session_path, json_file_name)
-            with open(json_path, 'w') as outfile:
-                json.dump(self.__dict__, outfile, indent=4)
+            journal.write_event_json(self.id, self.__dict__, self.session_path)
         else:
             print('No session.path, can not write JSON file.')
 
-    def rename_files(self):
-        print(f'rename_files CALLED for {self.id}, {self.catalog_number}')
-        # TODO re-create JSON after renaming image files to record new paths
-        if self.catalog_number is not None:
-            print('Catalog number exists, proceeding...')
-            # try:
-            # utilities.rename_uniquely(raw_image=self.original_raw_image, \
-            #    derived_image=self.original_derived_image, \
-            #    catalog_number=self.catalog_number, session_id=self.id)
-            if self.original_raw_image is not None:
-                new_raw_path = utilities.rename_uniquely(image_path=self.original_raw_image,
-                                                         catalog_number=self.catalog_number, image_event_id=self.id)
-                print('new_raw_path:', new_raw_path)
-                if new_raw_path:
-                    self.new_raw_image = new_raw_path
-                    self.serialize_image_event()
-            else:
-                print('No raw image found for catalog number:', self.catalog_number)
-            if self.original_derived_image is not None:
-                new_derived_path = utilities.rename_uniquely(image_path=self.original_derived_image,
-                                                             catalog_number=self.catalog_number, image_event_id=self.id)
-                # print('new_derived_path:', new_derived_path)
-                if new_derived_path:
-                    self.new_derived_image = new_derived_path
-                    self.serialize_image_event()
-            else:
-                print('No derived image found for catalog number:', self.catalog_number)
-        else:
-            print('Missing catalog number, terminating rename.')
+
+def parse_timestamp(timestamp=None):
+    """Parse a datetime.isoformat() string, which has no microseconds when they are 0."""
+    if '.' in timestamp:
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
 
 
 def derive_catalog_numbers(candidates=None):
     """
     This will generate valid catalog numbers based on local protocol
     Returns the canonical catalog number and a list of the other catalog numbers
-    all barcodes will be assessed
-    any barcodes matching valid_catalog_number_patterns will be further analyzed
-    Barcode rules will be applied:
-    TODO leading zeros stripped
-    prefix prepended
-    barcodes sorted
-    lowest value selected
+    The rules are configured in the CATALOG_NUMBERS section of the station
+    config, see catalog_rules.CatalogNumberRules.
     """
-    matches = set()
-    others = set()
-    # Filter out any barcodes which don't match valid_catalog_number_patterns
-    for pattern in valid_catalog_number_patterns:
-        p = re.compile(pattern)
-        # print('Evaluating pattern:', p)
-        for candidate in candidates:
-            candidate = str(candidate).strip()
-            m = p.match(candidate)
-            if m:
-                matches.add(m.group())
-            else:
-                others.add(candidate)
-    # Standadardize catalog number format
-    standardized_catalog_numbers = [REQUIRED_CATALOG_NUMBER_PREFIX+barcode if not barcode.startswith(REQUIRED_CATALOG_NUMBER_PREFIX)
-                                    else barcode for barcode in matches]
-    # Sort catalog numbers
-    sorted_catalog_numbers = utilities.sort_barcodes(standardized_catalog_numbers)
-    # Select first catalog number as the canonical identifier
-    if len(sorted_catalog_numbers) > 0:
-        catalog_number = sorted_catalog_numbers[0]
-        # remove catalog number from other catalog numbers
-        others.discard(catalog_number)
-    else:
-        catalog_number = None
-    other_catalog_numbers = list(others)
-    return catalog_number, other_catalog_numbers
+    return CATALOG_NUMBER_RULES.derive(candidates)
 
 
 class ImageHandler(PatternMatchingEventHandler):
@@ -492,13 +890,17 @@ class ImageHandler(PatternMatchingEventHandler):
         if event.event_type == 'created':
             # TODO 'created' event_type may only be needed for testing
             image_path = src_path
+        if event_type == 'closed':
+            # Only reported by some observers, the file is known to be complete
+            image_path = src_path
+        if event_type == 'deleted':
+            return
         if image_path:
             print('image_path:', image_path)
-            # image_event = self.session.register_image_event(image_path=image_path)
-            self.session.register_image_event(image_path=image_path)
-            #self.session.update_image_event_status()
-            #self.update_image_event_status()
-            SESSION_LOGGER.info('Image file registered: ' + image_path)
+            # Only queue the file here, processing runs in the session pipeline
+            # so the observer thread does not fall behind.
+            self.session.submit_image(image_path=image_path, closed=(event_type == 'closed'))
+            SESSION_LOGGER.info('Image file queued: ' + image_path)
         else:
             print('ERROR, no image_path')
             SESSION_LOGGER.error('No image path.')
@@ -508,20 +910,22 @@ class ImageHandler(PatternMatchingEventHandler):
 @click.option('-u', '--username', help='Your first initial and last name')
 @click.option('-c', '--collection', help='The collection code (e.g. VDB, BRIT)')
 @click.option('-p', '--project', help='The project code (e.g. Crataegus, TX-digi)')
-def main(directory=None, username=None, collection=None, project=None):
+@click.option('-r', '--resume', is_flag=True, help='Resume the last session in the directory after a crash.')
+def main(directory=None, username=None, collection=None, project=None, resume=False):
     # Gather session metadata in terminal prompts or command line switches
     # standalone_mode=False prevents click from exiting when all commands are complete
     # gather session information and start logging
     # Prompt user for parameters
-    if not username:
+    # When resuming, session metadata is read from the session journal
+    if not username and not resume:
         username = click.prompt('Please enter your first and last name')
         SESSION_LOGGER.info('username: ' + username)
         # session.username = session_username
-    if not collection:
+    if not collection and not resume:
         collection = click.prompt('Please enter the collection code (e.g. VDB, BRIT)')
         SESSION_LOGGER.info('collection: ' + collection)
         # session.collection_code = session_collection
-    if not project:
+    if not project and not resume:
         project = click.prompt('Please enter the project code (use \'none\' if no project or unknown.)')
         SESSION_LOGGER.info('project: ' + project)
         # session.project = session_project
@@ -538,6 +942,9 @@ def main(directory=None, username=None, collection=None, project=None):
     client.session.project_code = project
     client.session.collection_code = collection
     client.session.username = username
+    if resume:
+        if not client.session.resume():
+            quit()
 
     # Set up session logging
     log_filename = str(client.session.uuid) + '.log'
@@ -549,13 +956,17 @@ def main(directory=None, username=None, collection=None, project=None):
     session_handler.setFormatter(log_formatter)
     SESSION_LOGGER.addHandler(session_handler)
     SESSION_LOGGER.info('session.uuid: ' + client.session.uuid)
-    SESSION_LOGGER.info('session.username: ' + client.session.username)
-    SESSION_LOGGER.info('session.collection_code: ' + client.session.collection_code)
-    SESSION_LOGGER.info('session.project_code: ' + client.session.project_code)
+    SESSION_LOGGER.info('session.username: ' + str(client.session.username))
+    SESSION_LOGGER.info('session.collection_code: ' + str(client.session.collection_code))
+    SESSION_LOGGER.info('session.project_code: ' + str(client.session.project_code))
     SESSION_LOGGER.info('session.path: ' + client.session.path)
     # Set up cleanup actions
     # This may not be needed if Ctrl C works
     atexit.register(end_cli_session, session=client.session)
+    client.session.open_journal()
+    client.session.start_pipeline()
+    if resume:
+        client.session.reconcile_directory()
 
     # start watching session folder for file additions and changes
     event_handler = ImageHandler(session=client.session, patterns=IMAGE_PATTERNS)
@@ -581,11 +992,10 @@ def end_cli_session(session=None):
         print('Session username: {}'.format(session.username))
         print('Session ID: {}'.format(session.uuid))
         print('Session path: {}'.format(session.path))
+        session.stop_pipeline()
         print('Image event count:', len(session.image_events))
-
-        for event in session.image_events:
-            print(event.id, event.catalog_number)
-            event.rename_files()
+        session.rename_image_files()
+        session.close_journal()
         #print('Completing final sync...STUB')
         # os.system("rsync -arz " + session['path'] + " /Users/jbest/Desktop/demo_shared")
         session = None
@@ -12,7 +12,7 @@ from ui_clientform import Ui_DigitizationClient
 from ui_sessionform import Ui_SessionForm
 
 # table column indexes
-SEQUENCE, BARCODE, FILENAME, TIME, STATUS, STATUS_LEVEL = range(6)
+SEQUENCE, BARCODE, FILENAME, TIME, STATUS, STATUS_LEVEL, BLUR = range(7)
 # status colors
 INFO_COLOR = QColor(180, 200, 255)
 OK_COLOR = QColor(150, 255, 150)
@@ -164,6 +164,14 @@ class ClientForm(QMainWindow):
             # TODO - log this
             print('ALERT - No session started, can not add event')
 
+    def update_event(self, event=None):
+        """
+        called from client.py
+        Refreshes table display after an existing event is updated
+        """
+        if event:
+            self.emitter_inst.update()
+
     # @pyqtSlot()
     def update_table_view(self):
         # Test slot used to activate the real slot
@@ -286,7 +294,7 @@ class SessionTableModel(QAbstractTableModel):
         return(len(self.image_events))
 
     def columnCount(self, index=QModelIndex()):
-        return 6
+        return 7
 
     def data(self, index, role=Qt.DisplayRole):
         column = index.column()
@@ -307,6 +315,14 @@ class SessionTableModel(QAbstractTableModel):
                 return event.status
             elif column == STATUS_LEVEL:
                 return event.status_level
+            elif column == BLUR:
+                # None until the background blur QC has evaluated the derived image
+                if event.is_blurry is None:
+                    return ''
+                elif event.is_blurry:
+                    return 'BLURRY'
+                else:
+                    return 'OK'
         # Background color:
         # https://stackoverflow.com/a/44104745/560798
         if role == Qt.BackgroundRole:
@@ -320,6 +336,12 @@ class SessionTableModel(QAbstractTableModel):
                     return ERROR_COLOR
                 if status_level == 'OK':
                     return OK_COLOR
+            if column == BLUR:
+                blur = self.data(index=index, role=Qt.DisplayRole)
+                if blur == 'BLURRY':
+                    return WARNING_COLOR
+                if blur == 'OK':
+                    return OK_COLOR
                 #if self.data(index=index, role=Qt.DisplayRole) == "Young":
                 # return QBrush(Qt.yellow)
 
@@ -344,6 +366,8 @@ class SessionTableModel(QAbstractTableModel):
                 return "Status"
             elif section == STATUS_LEVEL:
                 return "Status level"
+            elif section == BLUR:
+                return "Blur"
         return int(section + 1)
 
 
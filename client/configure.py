@@ -54,6 +54,33 @@ def write_config_local(station_uuid=None, station_id='UNSPECIFIED'):
     config_local.set('LOCAL', '# The station_uuid must remain unique to each image station.', None)
     config_local['LOCAL']['station_uuid'] = station_uuid
     config_local['LOCAL']['station_id'] = station_id
+    config_local['INGEST'] = {}
+    config_local.set('INGEST', '# executor is thread or process, workers defaults to the number of CPUs.', None)
+    config_local['INGEST']['executor'] = 'thread'
+    config_local['INGEST']['evaluate_blur'] = 'true'
+    config_local.set('INGEST', '# blur is evaluated in a separate process pool, blur_workers defaults to half the workers.', None)
+    config_local['INGEST']['settle_time'] = '1.0'
+    config_local['INGEST']['processing_cache'] = 'true'
+    config_local['INGEST']['rename_immediately'] = 'false'
+    config_local.set('INGEST', '# fixity_digests = sha256 stores raw_image_sha256hash in addition to the md5 hash.', None)
+    config_local['BARCODES'] = {}
+    config_local['BARCODES']['learn_region'] = 'true'
+    config_local['BARCODES']['read_raw_preview'] = 'true'
+    config_local.set('BARCODES', '# Overrides accepted_barcode_symbologies in the shared ' + config_path + ' for this station.', None)
+    config_local.set('BARCODES', '# accepted_barcode_symbologies = CODE128, CODE39', None)
+    config_local.set('BARCODES', '# Catalog number rules may be set in a CATALOG_NUMBERS section here or in the shared '
+                     + config_path + ': patterns and preferred_patterns (one per line), prefix, strip_leading_zeros.', None)
+    config_local['BLUR'] = {}
+    config_local.set('BLUR', '# engine is haar or laplacian. laplacian also reads threshold and region (left, top, right, bottom).', None)
+    config_local['BLUR']['engine'] = 'haar'
+    config_local.set('BLUR', '# scale 2 or 4 evaluates blur on a reduced image, using haar thresholds from blur_calibration.py', None)
+    config_local['BLUR']['scale'] = '1'
+    config_local['BLUR']['calibration'] = 'blur_calibration.json'
+    config_local.set('BLUR', '# memory_budget (MB) evaluates very large images in strips, e.g. 256', None)
+    config_local['JOURNAL'] = {}
+    config_local['JOURNAL']['flush_every'] = '20'
+    config_local['JOURNAL']['flush_interval'] = '2.0'
+    config_local['JOURNAL']['fsync'] = 'true'
 
     with open('config_local.ini', 'w') as config_local_file:
         config_local.write(config_local_file)
@@ -0,0 +1,115 @@
+"""Read the JPEG preview embedded in a Canon CR2 raw file without decoding the raw data."""
+
+import logging
+import struct
+
+CR2_LOGGER = logging.getLogger('session_log')
+# TIFF tags locating embedded JPEG images
+STRIP_OFFSETS = 0x0111
+STRIP_BYTE_COUNTS = 0x0117
+JPEG_INTERCHANGE_FORMAT = 0x0201
+JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+# TIFF field type: (struct format, size in bytes)
+FIELD_TYPES = {3: ('H', 2), 4: ('L', 4)}
+MAX_IFDS = 4  # CR2 files have 4 IFDs, the raw data is in the last one
+CR2_MARKER = b'CR'
+JPEG_SOI = b'\xff\xd8'
+
+
+def read_ifd_values(cr2_file=None, byte_order='<', field_type=None, count=None, value_field=None):
+    """Return the SHORT or LONG values of an IFD entry, None for other types."""
+    if field_type not in FIELD_TYPES:
+        return None
+    value_format, value_size = FIELD_TYPES[field_type]
+    if value_size * count <= 4:
+        data = value_field[:value_size * count]
+    else:
+        offset = struct.unpack(byte_order + 'L', value_field)[0]
+        cr2_file.seek(offset)
+        data = cr2_file.read(value_size * count)
+    return list(struct.unpack(byte_order + value_format * count, data))
+
+
+def embedded_jpegs(file_path=None):
+    """
+    Locate the images embedded in a CR2 (TIFF container) file.
+
+    Only the TIFF header and image file directories (IFDs) are read. The
+    raw IFD, whose lossless JPEG data is the raw image itself, is skipped.
+
+    Returns
+    -------
+    list
+        (offset, length) of each embedded image strip, JPEG or not.
+    """
+    jpegs = []
+    with open(file_path, 'rb') as cr2_file:
+        header = cr2_file.read(16)
+        if header[:2] == b'II':
+            byte_order = '<'
+        elif header[:2] == b'MM':
+            byte_order = '>'
+        else:
+            return jpegs
+        magic, ifd_offset = struct.unpack(byte_order + 'HL', header[2:8])
+        if magic != 42:
+            return jpegs
+        raw_ifd_offset = None
+        if header[8:10] == CR2_MARKER:
+            raw_ifd_offset = struct.unpack(byte_order + 'L', header[12:16])[0]
+        for ifd_number in range(MAX_IFDS):
+            if ifd_offset == 0:
+                break
+            current_ifd_offset = ifd_offset
+            cr2_file.seek(ifd_offset)
+            entry_count = struct.unpack(byte_order + 'H', cr2_file.read(2))[0]
+            entries = cr2_file.read(entry_count * 12)
+            ifd_offset = struct.unpack(byte_order + 'L', cr2_file.read(4))[0]
+            if current_ifd_offset == raw_ifd_offset:
+                continue
+            tags = {}
+            for entry_number in range(entry_count):
+                entry = entries[entry_number * 12:entry_number * 12 + 12]
+                tag, field_type, count = struct.unpack(byte_order + 'HHL', entry[:8])
+                if tag in (STRIP_OFFSETS, STRIP_BYTE_COUNTS, JPEG_INTERCHANGE_FORMAT, JPEG_INTERCHANGE_FORMAT_LENGTH):
+                    tags[tag] = (field_type, count, entry[8:12])
+            for offset_tag, length_tag in [(STRIP_OFFSETS, STRIP_BYTE_COUNTS),
+                                           (JPEG_INTERCHANGE_FORMAT, JPEG_INTERCHANGE_FORMAT_LENGTH)]:
+                if offset_tag in tags and length_tag in tags:
+                    offsets = read_ifd_values(cr2_file, byte_order, *tags[offset_tag])
+                    lengths = read_ifd_values(cr2_file, byte_order, *tags[length_tag])
+                    # A JPEG is stored as a single strip
+                    if offsets and lengths and len(offsets) == 1 and len(lengths) == 1:
+                        jpegs.append((offsets[0], lengths[0]))
+    return jpegs
+
+
+def embedded_preview(file_path=None):
+    """
+    Return the largest JPEG embedded in a CR2 file.
+
+    For CR2 files this is the full size preview in IFD0.
+
+    Returns
+    -------
+    bytes
+        The JPEG data, or None if no preview is found.
+    """
+    try:
+        jpegs = embedded_jpegs(file_path)
+        if not jpegs:
+            CR2_LOGGER.info('No embedded JPEG found in file: ' + file_path)
+            return None
+        with open(file_path, 'rb') as cr2_file:
+            # Largest first, uncompressed strips (IFD2) are skipped by the JPEG marker check
+            for offset, length in sorted(jpegs, key=lambda jpeg: jpeg[1], reverse=True):
+                cr2_file.seek(offset)
+                if cr2_file.read(2) == JPEG_SOI:
+                    cr2_file.seek(offset)
+                    return cr2_file.read(length)
+    except (OSError, struct.error) as e:
+        print('ERROR: unable to read CR2 preview:', file_path, e)
+        CR2_LOGGER.exception('Unable to read CR2 preview: ' + file_path)
+        return None
+    CR2_LOGGER.info('No embedded JPEG found in file: ' + file_path)
+    return None
@@ -0,0 +1,56 @@
+"""Image file read once and shared by the hashing and barcode stages."""
+
+import io
+
+from PIL import Image
+
+
+class ImageFile():
+    """
+    Bytes of an image file, read on first use and kept for the other stages.
+
+    Hashing and barcode decoding of a derived image would otherwise each
+    read the file from disk. The full resolution grayscale decode is also
+    kept for the barcode scales that use it.
+
+    Parameters
+    ----------
+    file_path : string
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self._data = None
+        self._grayscale = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def data(self):
+        """The file contents, read in a single call."""
+        if self._data is None:
+            with open(self.file_path, 'rb') as f:
+                self._data = f.read()
+        return self._data
+
+    def stream(self):
+        """Return a new file-like object over the contents (not copied), e.g. for Image.open."""
+        return io.BytesIO(self.data)
+
+    def grayscale(self):
+        """Return the full resolution grayscale ('L') image, decoded once."""
+        if self._grayscale is None:
+            image = Image.open(self.stream())
+            if image.format == 'JPEG':
+                # decode the luminance channel only
+                image.draft('L', image.size)
+            self._grayscale = image.convert('L')
+        return self._grayscale
+
+    def close(self):
+        self._data = None
+        self._grayscale = None
@@ -0,0 +1,186 @@
+"""Append-only session journal of image event changes."""
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import utilities
+
+JOURNAL_LOGGER = logging.getLogger('session_log')
+JOURNAL_EXTENSION = '.journal.jsonl'
+DEFAULT_FLUSH_EVERY = 20  # records buffered before writing
+DEFAULT_FLUSH_INTERVAL = 2.0  # seconds a record stays buffered at most, about
+
+
+class SessionJournal():
+    """
+    Record session and image event changes as JSON lines.
+
+    Each line is {"op": "session"|"create"|"update", "id": ..., "time": ..., "data": {...}}.
+    A create record holds all event values, an update record only the values
+    that changed. Records are buffered and written in batches, with an
+    optional fsync after each batch. A flusher thread writes records left in
+    the buffer for flush_interval seconds, e.g. the last ones before a pause.
+    """
+
+    def __init__(self, path=None, flush_every=DEFAULT_FLUSH_EVERY, flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=True):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.first_buffered = None  # time the oldest buffered record was added
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.stopped = threading.Event()
+        self.thread = None
+        if flush_interval:
+            self.thread = threading.Thread(target=self.run, name='SessionJournalFlusher', daemon=True)
+            self.thread.start()
+        JOURNAL_LOGGER.info('Session journal opened: ' + path)
+
+    def record(self, op=None, record_id=None, data=None):
+        """Add a record, writing the buffer when it is full or old enough."""
+        line = json.dumps({'op': op, 'id': record_id, 'time': datetime.datetime.now().isoformat(), 'data': data})
+        with self.lock:
+            if not self.buffer:
+                self.first_buffered = time.monotonic()
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+        self.first_buffered = None
+        self.last_flush = time.monotonic()
+
+    def run(self):
+        # checks twice per interval, so a record is written at most 1.5 intervals after it was added
+        while not self.stopped.wait(self.flush_interval / 2):
+            try:
+                with self.lock:
+                    if self.first_buffered is not None and \
+                            time.monotonic() - self.first_buffered >= self.flush_interval:
+                        self._flush()
+            except Exception:
+                JOURNAL_LOGGER.exception('Session journal flush failed: ' + self.path)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self._flush()
+            self.file.close()
+        JOURNAL_LOGGER.info('Session journal closed: ' + self.path)
+
+
+def latest_journal(directory=None):
+    """Return the path of the most recently written journal in a session folder, or None."""
+    latest_path = None
+    latest_mtime = None
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(JOURNAL_EXTENSION):
+                mtime = entry.stat().st_mtime
+                if latest_mtime is None or mtime > latest_mtime:
+                    latest_path = entry.path
+                    latest_mtime = mtime
+    return latest_path
+
+
+def read_journal(path=None):
+    """
+    Replay a journal.
+
+    A partly written last line, left by a crash, is ignored.
+
+    Returns
+    -------
+    tuple
+        (session values, dict of event id: event values in creation order)
+    """
+    session_data = {}
+    events = {}
+    with open(path, encoding='utf-8') as journal_file:
+        for line_number, line in enumerate(journal_file, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                JOURNAL_LOGGER.error('Skipping unreadable journal line ' + str(line_number) + ' in ' + path)
+                continue
+            if record['op'] == 'session':
+                session_data.update(record['data'])
+            elif record['op'] == 'create':
+                events[record['id']] = dict(record['data'])
+            elif record['op'] == 'update':
+                events.setdefault(record['id'], {}).update(record['data'])
+    return session_data, events
+
+
+def compact_journal(path=None, output_directory=None, skip_event_ids=None):
+    """
+    Write the final JSON file of each image event recorded in a journal.
+
+    The files match those written by ImageEvent.serialize_image_event, as read
+    by server/compile.py. Events in skip_event_ids already have an up to date
+    JSON file, e.g. written when their files were renamed during the session.
+
+    Returns
+    -------
+    list
+        Paths of the JSON files written.
+    """
+    session_data, events = read_journal(path)
+    if output_directory is None:
+        output_directory = os.path.dirname(path)
+    json_paths = []
+    skip_event_ids = set(skip_event_ids or [])
+    for event_id, event_data in events.items():
+        if event_id not in skip_event_ids:
+            json_paths.append(write_event_json(event_id, event_data, output_directory))
+    JOURNAL_LOGGER.info('Compacted journal ' + path + ' into ' + str(len(json_paths)) + ' JSON files.')
+    return json_paths
+
+
+def write_event_json(event_id=None, event_data=None, output_directory=None):
+    """
+    Write the JSON file of an image event, named by utilities.event_json_filename.
+
+    If the catalog number file holds another event, e.g. a re-shot specimen,
+    the event UUID is added to the name as for renamed image files.
+    """
+    catalog_number = event_data.get('catalog_number')
+    json_file_name = utilities.event_json_filename(catalog_number=catalog_number,
+                                                   original_filename=event_data.get('original_filename'),
+                                                   image_event_id=event_id)
+    json_path = os.path.join(output_directory, json_file_name)
+    if catalog_number and json_event_id(json_path) not in (None, event_id):
+        json_path = os.path.join(output_directory, catalog_number + '_' + event_id + '.JSON')
+        JOURNAL_LOGGER.info('Catalog number ' + catalog_number + ' has more than one image event, writing ' +
+                            json_path)
+    with open(json_path, 'w') as outfile:
+        json.dump(event_data, outfile, indent=4)
+    return json_path
+
+
+def json_event_id(json_path=None):
+    """Return the event id in an existing event JSON file, None if there is no readable file."""
+    try:
+        with open(json_path) as json_file:
+            return json.load(json_file).get('id')
+    except (OSError, ValueError, AttributeError):
+        return None
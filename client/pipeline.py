@@ -0,0 +1,327 @@
+"""Staged ingest pipeline used to process image files off the watcher thread."""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import utilities
+import blur_engines
+import cr2
+import image_file
+
+PIPELINE_LOGGER = logging.getLogger('session_log')
+RAW_IMAGE_EXTENSIONS = ['.CR2']
+DERIVED_IMAGE_EXTENSIONS = ['.JPG']
+EXECUTOR_TYPES = ['thread', 'process']
+DEFAULT_EXECUTOR_TYPE = 'thread'
+DEFAULT_SETTLE_TIME = 1.0  # seconds a file's size and mtime must be unchanged
+DEFAULT_POLL_INTERVAL = 0.25
+
+
+def analyze_image_file(image_path=None, cache=None, barcode_region=None, symbologies=None,
+                       read_raw_preview=False, catalog_number_rules=None, fixity_digests=None):
+    """
+    Compute the metadata for a single image file.
+
+    This is the work stage of the pipeline (hashing and barcode reading).
+    It is a module level function returning only plain values so it can be
+    run in either a thread or a process pool. Blur is evaluated separately,
+    see evaluate_blur_file.
+
+    Parameters
+    ----------
+    image_path : string
+    cache : processing_cache.ProcessingCache
+        Optional cache of results for unchanged files.
+    barcode_region : list
+        Normalized box where the station's barcodes are usually found.
+    symbologies : list
+        Names of the barcode symbologies accepted by the station, None for all.
+    read_raw_preview : bool
+        Read barcodes from the JPEG preview embedded in raw files.
+    catalog_number_rules : catalog_rules.CatalogNumberRules
+        Barcode decoding escalates to higher resolutions until a valid catalog
+        number is found. Default stops at the first barcode found.
+    fixity_digests : list
+        Digests of raw files computed in the same read as the md5 hash, e.g. ['sha256'].
+
+    Returns
+    -------
+    dict
+        The image_path and the values computed for the file type.
+        barcode_scales counts the barcode decoding scale used.
+        fixity holds the fixity_digests of raw files.
+
+    """
+    result = {'image_path': image_path}
+    if image_path is None:
+        return result
+    validator = None
+    if catalog_number_rules is not None:
+        validator = catalog_number_rules.has_catalog_number
+    file_name, file_extension = os.path.splitext(image_path)
+    if file_extension.upper() in RAW_IMAGE_EXTENSIONS:
+        result['creation_date'] = utilities.creation_date(file_path=image_path)
+        if fixity_digests:
+            digests = utilities.file_hashes(file_path=image_path, algorithms=['md5'] + list(fixity_digests),
+                                            cache=cache)
+            result['md5hash'] = digests.get('md5')
+            result['fixity'] = {algorithm: digests.get(algorithm) for algorithm in fixity_digests}
+        else:
+            result['md5hash'] = utilities.md5hash(file_path=image_path, cache=cache)
+        if read_raw_preview:
+            barcode_scale_counts = collections.Counter()
+            preview = cr2.embedded_preview(image_path)
+            if preview is not None:
+                result['barcodes'] = utilities.barcodes(file_path=image_path, cache=cache, counts=barcode_scale_counts,
+                                                        region=barcode_region, symbologies=symbologies,
+                                                        image_data=preview, validator=validator)
+            result['barcode_scales'] = dict(barcode_scale_counts)
+    elif file_extension.upper() in DERIVED_IMAGE_EXTENSIONS:
+        # The file is read at most once, and only if a stage misses the cache
+        with image_file.ImageFile(image_path) as derived_image_file:
+            result['md5hash'] = utilities.md5hash(file_path=image_path, cache=cache, image_file=derived_image_file)
+            barcode_scale_counts = collections.Counter()
+            result['barcodes'] = utilities.barcodes(file_path=image_path, cache=cache, counts=barcode_scale_counts,
+                                                    region=barcode_region, symbologies=symbologies,
+                                                    validator=validator, image_file=derived_image_file)
+            result['barcode_scales'] = dict(barcode_scale_counts)
+    return result
+
+
+def evaluate_blur_file(image_path=None, blur_engine=None, cache=None):
+    """
+    Evaluate the blurriness of a derived image.
+
+    Run by IngestPipeline in a separate process pool once the image's barcodes
+    have been merged, so blur scoring does not delay the catalog number. The
+    trade-off is that the image is read and decoded again from disk (or from
+    the cache), rather than sharing the grayscale decode of analyze_image_file.
+
+    Returns
+    -------
+    dict
+        The image_path and, unless evaluation failed, is_blurry, blurriness and blur_engine.
+    """
+    result = {'image_path': image_path}
+    if blur_engine is None:
+        blur_engine = blur_engines.create_engine()
+    try:
+        is_blurry, blurriness = blur_engine.evaluate(image=image_path, cache=cache)
+        result['is_blurry'] = is_blurry
+        result['blurriness'] = blurriness
+        result['blur_engine'] = blur_engine.name
+    except Exception as e:
+        print('evaluate_blur_file: blur ERROR:', e)
+        PIPELINE_LOGGER.exception('Unable to evaluate blurriness: ' + str(image_path))
+    return result
+
+
+def scan_image_files(path=None):
+    """
+    Find the raw and derived image files in a session folder and its subfolders.
+
+    Yields
+    ------
+    os.DirEntry
+    """
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                file_name, file_extension = os.path.splitext(entry.name)
+                if file_extension.upper() in RAW_IMAGE_EXTENSIONS + DERIVED_IMAGE_EXTENSIONS:
+                    yield entry
+
+
+class IngestPipeline():
+    """
+    Process image files in a worker pool and merge the results into the session.
+
+    The watchdog handler only submits paths. Hashing and barcode reading run
+    in a thread or process pool, then the results are merged into the matching
+    ImageEvent by Session.register_image_event. Blur evaluation of derived
+    images then runs in its own process pool and is merged by
+    Session.register_blur_result.
+    """
+
+    def __init__(self, session=None, workers=None, executor_type=DEFAULT_EXECUTOR_TYPE, evaluate_blur=False, cache=None,
+                 barcode_region=None, symbologies=None, read_raw_preview=False, catalog_number_rules=None,
+                 fixity_digests=None, blur_engine=None, blur_workers=None):
+        if executor_type not in EXECUTOR_TYPES:
+            PIPELINE_LOGGER.error('Unknown executor type: ' + str(executor_type) + ', using ' + DEFAULT_EXECUTOR_TYPE)
+            executor_type = DEFAULT_EXECUTOR_TYPE
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.session = session
+        self.workers = workers
+        self.executor_type = executor_type
+        self.cache = cache
+        self.barcode_region = barcode_region
+        self.symbologies = symbologies
+        self.read_raw_preview = read_raw_preview
+        self.catalog_number_rules = catalog_number_rules
+        self.fixity_digests = fixity_digests
+        self.blur_engine = blur_engine
+        # Barcode decoding scale that succeeded, counted over all workers
+        self.barcode_scale_counts = collections.Counter()
+        if executor_type == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.blur_executor = None
+        if evaluate_blur:
+            if not blur_workers:
+                # leave CPUs for hashing and barcode reading
+                blur_workers = max(1, workers // 2)
+            self.blur_executor = concurrent.futures.ProcessPoolExecutor(max_workers=blur_workers)
+            PIPELINE_LOGGER.info('Blur QC started: process pool with ' + str(blur_workers) + ' workers.')
+        PIPELINE_LOGGER.info('Ingest pipeline started: ' + executor_type + ' pool with ' + str(workers) + ' workers.')
+
+    def submit(self, image_path=None):
+        """Queue an image file for processing."""
+        if image_path is None:
+            PIPELINE_LOGGER.error('No image path submitted to ingest pipeline.')
+            return None
+        region = None
+        if self.barcode_region is not None:
+            region = self.barcode_region.region()
+        read_raw_preview = self.read_raw_preview
+        if read_raw_preview and self.session is not None and self.session.has_derived_image(image_path):
+            # barcodes are already read from the derived image
+            read_raw_preview = False
+        # blur is evaluated after the barcodes are merged, see merge
+        future = self.executor.submit(analyze_image_file, image_path, self.cache, region,
+                                      self.symbologies, read_raw_preview, self.catalog_number_rules,
+                                      self.fixity_digests)
+        future.add_done_callback(self.merge)
+        return future
+
+    def merge(self, future):
+        """Merge a completed result into the session."""
+        try:
+            result = future.result()
+        except Exception as e:
+            print('IngestPipeline: ERROR processing file:', e)
+            PIPELINE_LOGGER.exception('Ingest pipeline worker failed.')
+            return
+        self.barcode_scale_counts.update(result.get('barcode_scales', {}))
+        if self.session:
+            self.session.register_image_event(image_path=result['image_path'], file_metadata=result)
+        if self.blur_executor is not None:
+            file_name, file_extension = os.path.splitext(result['image_path'])
+            if file_extension.upper() in DERIVED_IMAGE_EXTENSIONS:
+                blur_future = self.blur_executor.submit(evaluate_blur_file, result['image_path'], self.blur_engine,
+                                                        self.cache)
+                blur_future.add_done_callback(self.merge_blur)
+
+    def merge_blur(self, future):
+        """Merge a completed blur evaluation into the session."""
+        try:
+            result = future.result()
+        except Exception as e:
+            print('IngestPipeline: ERROR evaluating blur:', e)
+            PIPELINE_LOGGER.exception('Blur QC worker failed.')
+            return
+        if self.session:
+            self.session.register_blur_result(image_path=result['image_path'], blur_result=result)
+
+    def shutdown(self, wait=True):
+        """Stop accepting files and, by default, wait for queued files to finish."""
+        self.executor.shutdown(wait=wait)
+        # queued files may have submitted blur evaluations until now
+        if self.blur_executor is not None:
+            self.blur_executor.shutdown(wait=wait)
+        print('Barcode decoding scales:', dict(self.barcode_scale_counts))
+        PIPELINE_LOGGER.info('Ingest pipeline stopped. Barcode decoding scales: ' + str(dict(self.barcode_scale_counts)))
+
+
+class PendingFile():
+    """Write state of a file waiting in WriteCompletionMonitor."""
+
+    def __init__(self, image_path=None):
+        self.image_path = image_path
+        self.signature = None  # (size, mtime) at the last check
+        self.stable_since = None
+
+
+class WriteCompletionMonitor():
+    """
+    Hold watched files until they are completely written, then submit each once.
+
+    The Canon software fires several modified events while writing a single
+    file. Each notification only marks the path as pending, a polling thread
+    submits the path once its size and mtime have not changed for settle_time
+    seconds. A closed event submits the path immediately.
+    """
+
+    def __init__(self, submit=None, settle_time=DEFAULT_SETTLE_TIME, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.submit = submit
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='WriteCompletionMonitor', daemon=True)
+        self.thread.start()
+
+    def notify(self, image_path=None):
+        """Record a file event, bursts of events for a path collapse into one pending entry."""
+        if image_path is None:
+            return
+        with self.lock:
+            if image_path not in self.pending:
+                self.pending[image_path] = PendingFile(image_path=image_path)
+
+    def file_closed(self, image_path=None):
+        """Submit a file immediately once the writer has closed it."""
+        with self.lock:
+            self.pending.pop(image_path, None)
+        if image_path is not None:
+            self.submit(image_path)
+
+    def check(self):
+        """Submit pending files whose size and mtime are stable."""
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            for image_path, pending_file in list(self.pending.items()):
+                try:
+                    stat = os.stat(image_path)
+                except FileNotFoundError:
+                    # Renamed or removed while being written, a moved event reports the new path.
+                    del self.pending[image_path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if signature != pending_file.signature:
+                    pending_file.signature = signature
+                    pending_file.stable_since = now
+                elif stat.st_size > 0 and now - pending_file.stable_since >= self.settle_time:
+                    ready.append(image_path)
+                    del self.pending[image_path]
+        for image_path in ready:
+            self.submit(image_path)
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.check()
+            except Exception:
+                PIPELINE_LOGGER.exception('Write completion check failed.')
+
+    def stop(self):
+        """Stop polling and submit any files still pending."""
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            remaining = list(self.pending)
+            self.pending.clear()
+        for image_path in remaining:
+            if os.path.exists(image_path):
+                self.submit(image_path)
@@ -0,0 +1,151 @@
+"""Persistent cache of file processing results, stored in the session folder."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_LOGGER = logging.getLogger('session_log')
+CACHE_FILENAME = '.processing_cache.sqlite'
+# Increment when a change to hashing, barcode or blur code makes stored results stale.
+CACHE_VERSION = 3
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_MAX_AGE_DAYS = 90
+EVICT_EVERY = 500  # stores between eviction passes
+
+
+def file_key(file_path=None):
+    """
+    Return the cache key of a file.
+
+    Returns
+    -------
+    tuple
+        (path, size, mtime_ns, inode), or None if the file can not be read.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class ProcessingCache():
+    """
+    SQLite cache of hashes, barcodes and blur scores keyed by (path, size, mtime, inode).
+
+    Invalidation: a result is only returned while the file's size, mtime and
+    inode match the values stored with it, a stale result is deleted on lookup.
+    The whole cache is dropped when CACHE_VERSION changes.
+    Eviction: results not used for max_age_days are deleted, then the least
+    recently used results beyond max_entries.
+
+    The cache holds one connection per thread and can be pickled, so the same
+    instance can be handed to thread or process pool workers.
+    """
+
+    def __init__(self, db_path=None, max_entries=DEFAULT_MAX_ENTRIES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.local = threading.local()
+        self.store_count = 0
+        connection = self.connection()
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != CACHE_VERSION:
+            with connection:
+                connection.execute('DROP TABLE IF EXISTS file_results')
+                connection.execute('PRAGMA user_version = ' + str(int(CACHE_VERSION)))
+        with connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS file_results (
+                path TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                value TEXT, last_access REAL, PRIMARY KEY (path, name))''')
+            connection.execute('CREATE INDEX IF NOT EXISTS file_results_last_access ON file_results (last_access)')
+        self.evict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def lookup(self, file_path=None, name=None):
+        """
+        Look up a stored result for a file.
+
+        Returns
+        -------
+        tuple
+            (found, value). found is False on a miss or if the file changed.
+        """
+        key = file_key(file_path)
+        if key is None:
+            return False, None
+        path, size, mtime_ns, inode = key
+        try:
+            connection = self.connection()
+            row = connection.execute('SELECT size, mtime_ns, inode, value FROM file_results WHERE path = ? AND name = ?',
+                                     (path, name)).fetchone()
+            if row is None:
+                return False, None
+            with connection:
+                if tuple(row[:3]) != (size, mtime_ns, inode):
+                    connection.execute('DELETE FROM file_results WHERE path = ? AND name = ?', (path, name))
+                    return False, None
+                connection.execute('UPDATE file_results SET last_access = ? WHERE path = ? AND name = ?',
+                                   (time.time(), path, name))
+            return True, json.loads(row[3])
+        except sqlite3.Error:
+            CACHE_LOGGER.exception('Processing cache lookup failed: ' + str(file_path))
+            return False, None
+
+    def store(self, file_path=None, name=None, value=None):
+        """Store a result for a file, replacing any earlier result."""
+        key = file_key(file_path)
+        if key is None:
+            return
+        path, size, mtime_ns, inode = key
+        try:
+            with self.connection() as connection:
+                connection.execute('INSERT OR REPLACE INTO file_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (path, name, size, mtime_ns, inode, json.dumps(value), time.time()))
+        except sqlite3.Error:
+            CACHE_LOGGER.exception('Processing cache store failed: ' + str(file_path))
+            return
+        self.store_count += 1
+        if self.store_count % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Delete results older than max_age_days and the least recently used beyond max_entries."""
+        try:
+            with self.connection() as connection:
+                if self.max_age_days:
+                    oldest = time.time() - self.max_age_days * 86400
+                    connection.execute('DELETE FROM file_results WHERE last_access < ?', (oldest,))
+                if self.max_entries:
+                    connection.execute('''DELETE FROM file_results WHERE rowid IN (
+                        SELECT rowid FROM file_results ORDER BY last_access DESC LIMIT -1 OFFSET ?)''',
+                                       (self.max_entries,))
+        except sqlite3.Error:
+            CACHE_LOGGER.exception('Processing cache eviction failed.')
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
@@ -0,0 +1,192 @@
+"""Plan and run the end of session renames of image files as a single transaction."""
+
+import datetime
+import json
+import logging
+import os
+
+RENAME_LOGGER = logging.getLogger('session_log')
+MANIFEST_EXTENSION = '.rename_manifest.json'
+# (original path attribute, renamed path attribute) of ImageEvent
+IMAGE_FIELDS = [('original_raw_image', 'new_raw_image'), ('original_derived_image', 'new_derived_image')]
+# Characters that can not be used in a file name on the stations' file systems
+INVALID_FILENAME_CHARACTERS = set('<>:"/\\|?*')
+IN_PROGRESS = 'in progress'
+COMPLETE = 'complete'
+ROLLED_BACK = 'rolled back'
+
+
+def manifest_path(directory=None, session_uuid=None):
+    return os.path.join(directory, str(session_uuid) + MANIFEST_EXTENSION)
+
+
+class RenamePlan():
+    """
+    Renames of the image files of a session, resolved before any file is moved.
+
+    Each folder is listed once. Target names are
+    the catalog number, or the catalog number and the image event UUID if
+    that name is taken. Names are compared case-insensitively where the OS
+    does (os.path.normcase) and a file renamed away frees its name for later
+    events, as when the files were renamed one at a time.
+
+    Parameters
+    ----------
+    image_events : list
+        ImageEvent objects, renamed in this order.
+    listings : dict
+        Folder listings kept between plans, e.g. by a session renaming one
+        event at a time, updated with the planned renames. Files added to a
+        folder since it was listed are checked on disk.
+    """
+
+    def __init__(self, image_events=None, listings=None):
+        self.renames = []  # dicts of event, field, source, target
+        self.skipped = []  # (image path, reason)
+        self.shared_listings = listings is not None
+        self.listings = {} if listings is None else listings  # directory: set of normcased file names
+        for image_event in image_events or []:
+            self.add_event(image_event)
+
+    def listing(self, directory=None):
+        names = self.listings.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as entries:
+                    names = set(os.path.normcase(entry.name) for entry in entries)
+            except OSError:
+                RENAME_LOGGER.exception('Unable to list folder: ' + str(directory))
+                names = set()
+            self.listings[directory] = names
+        return names
+
+    def is_taken(self, directory=None, name=None):
+        """Return True if a file name is used in a folder, or planned to be."""
+        names = self.listing(directory)
+        if os.path.normcase(name) in names:
+            return True
+        if self.shared_listings and os.path.exists(os.path.join(directory, name)):
+            names.add(os.path.normcase(name))
+            return True
+        return False
+
+    def add_event(self, image_event=None):
+        """Plan the renames of the image files of an event that are not renamed yet."""
+        catalog_number = image_event.catalog_number
+        if catalog_number is None:
+            return
+        if INVALID_FILENAME_CHARACTERS.intersection(catalog_number):
+            self.skipped.append((image_event.original_filename, 'invalid file name: ' + catalog_number))
+            return
+        for original_field, new_field in IMAGE_FIELDS:
+            source = getattr(image_event, original_field)
+            if source is None or getattr(image_event, new_field) is not None:
+                continue
+            directory, basename = os.path.split(source)
+            names = self.listing(directory)
+            if os.path.normcase(basename) not in names:
+                if not (self.shared_listings and os.path.exists(source)):
+                    self.skipped.append((source, 'file not found'))
+                    continue
+                names.add(os.path.normcase(basename))
+            extension = os.path.splitext(basename)[1]
+            target_name = catalog_number + extension
+            if self.is_taken(directory, target_name):
+                target_name = catalog_number + '_' + image_event.id + extension
+                if self.is_taken(directory, target_name):
+                    self.skipped.append((source, 'path is not unique: ' + target_name))
+                    continue
+            names.discard(os.path.normcase(basename))
+            names.add(os.path.normcase(target_name))
+            self.renames.append({'event': image_event, 'field': new_field, 'source': source,
+                                 'target': os.path.join(directory, target_name)})
+
+    def manifest(self, status=IN_PROGRESS):
+        return {'status': status, 'updated': datetime.datetime.now().isoformat(),
+                'renames': [{'event_id': rename['event'].id, 'field': rename['field'],
+                             'source': rename['source'], 'target': rename['target']} for rename in self.renames]}
+
+    def execute(self, manifest_path=None):
+        """
+        Rename the planned files.
+
+        The manifest is written before the first rename. If a rename fails the
+        files already renamed are renamed back and no event is changed. Once all
+        files are renamed new_raw_image and new_derived_image are set.
+
+        Returns
+        -------
+        bool
+            True if every planned file was renamed.
+        """
+        for image_path, reason in self.skipped:
+            print('Not renaming:', image_path, reason)
+            RENAME_LOGGER.error('Not renaming: ' + str(image_path) + ' ' + reason)
+        if not self.renames:
+            return True
+        if manifest_path:
+            write_manifest(manifest_path, self.manifest(IN_PROGRESS))
+        completed = []
+        try:
+            for rename in self.renames:
+                os.rename(rename['source'], rename['target'])
+                completed.append(rename)
+        except OSError as e:
+            print('ERROR: unable to rename', rename['source'], 'to', rename['target'], e, '- rolling back.')
+            RENAME_LOGGER.exception('Unable to rename ' + rename['source'] + ' to ' + rename['target'] +
+                                    ', rolling back ' + str(len(completed)) + ' renames.')
+            rollback(completed)
+            if manifest_path:
+                write_manifest(manifest_path, self.manifest(ROLLED_BACK))
+            return False
+        for rename in self.renames:
+            setattr(rename['event'], rename['field'], rename['target'])
+        if manifest_path:
+            write_manifest(manifest_path, self.manifest(COMPLETE))
+        RENAME_LOGGER.info('Renamed ' + str(len(self.renames)) + ' image files.')
+        return True
+
+
+def write_manifest(path=None, manifest=None):
+    """Write a manifest, replacing the previous version atomically."""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def rollback(renames=None):
+    """Rename files back, last first. Files that were not renamed are left in place."""
+    for rename in reversed(renames):
+        if os.path.exists(rename['target']) and not os.path.exists(rename['source']):
+            try:
+                os.rename(rename['target'], rename['source'])
+            except OSError:
+                print('ERROR: unable to roll back rename of', rename['source'])
+                RENAME_LOGGER.exception('Unable to roll back rename: ' + rename['target'] + ' to ' + rename['source'])
+
+
+def recover(path=None):
+    """
+    Roll back the renames of a manifest left in progress, e.g. by a crash at the end of a session.
+
+    Returns
+    -------
+    bool
+        True if renames were rolled back.
+    """
+    try:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('status') != IN_PROGRESS:
+        return False
+    print('Rolling back interrupted renames:', path)
+    RENAME_LOGGER.warning('Rolling back interrupted renames: ' + path)
+    rollback(manifest['renames'])
+    manifest['status'] = ROLLED_BACK
+    write_manifest(path, manifest)
+    return True
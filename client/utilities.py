@@ -1,51 +1,209 @@
 """A collection of functions supporting image processing workflows."""
 
+import collections
+import io
 import platform
 import os
 import datetime
 import re
-import sys
 import logging
 from hashlib import md5
 from PIL import Image
-from pyzbar.pyzbar import decode
+from pyzbar.pyzbar import decode, ZBarSymbol
+
+import hashing
 
 UTILITIES_LOGGER = logging.getLogger('session_log')
 
 
-def barcodes(file_path=None):
+def barcodes(file_path=None, cache=None, validator=None, scales=None, counts=None, region=None, symbologies=None,
+             image_data=None, image_file=None):
     """
     Extract all barcode values and symbology types from an image file.
 
+    Decoding is tried on reduced resolution versions of the image first and
+    only escalates to full resolution when nothing valid is found.
+    If a region is given, a crop of the region is tried first at each scale
+    before the whole frame.
+
     Paramaters
     ----------
     file_path : string
+    cache : processing_cache.ProcessingCache
+        Optional cache of results for unchanged files.
+    validator : callable
+        Takes the list of barcode dicts found at one scale and returns True
+        if they are good enough to stop. Default accepts any barcode.
+    scales : list
+        Reduction factors tried in order, 1 is full resolution.
+        Default is BARCODE_SCALES.
+    counts : collections.Counter
+        Counts the scale that succeeded ('1/4', '1/2', '1/1', prefixed
+        'region ' for the region crop), 'none' or 'cached'.
+        Default is BARCODE_SCALE_COUNTS.
+    region : list
+        Normalized [left, top, right, bottom] box where a barcode is expected.
+    symbologies : list
+        Names of the symbologies to decode (e.g. ['CODE128', 'CODE39']).
+        Default decodes every symbology zbar supports.
+    image_data : bytes
+        An image embedded in file_path (e.g. a CR2 preview), decoded
+        instead of the file itself. Cached separately from the file.
+    image_file : image_file.ImageFile
+        The contents of file_path already read, full resolution decoding
+        uses its shared grayscale image.
+
+
+    Returns
+    -------
+    list
+        A list of dicts with the barcode type (symbology), data (barcode value)
+        and rect (normalized [left, top, right, bottom] position in the image).
+
+    """
+    if counts is None:
+        counts = BARCODE_SCALE_COUNTS
+    cache_name = 'barcodes'
+    if image_data is not None:
+        cache_name = 'preview_barcodes'
+    if symbologies:
+        cache_name += ':' + ','.join(sorted(symbologies))
+    if cache is not None:
+        found, barcodes_list = cache.lookup(file_path=file_path, name=cache_name)
+        if found:
+            counts['cached'] += 1
+            return barcodes_list
+    if scales is None:
+        scales = BARCODE_SCALES
+    # the region crop and then the whole frame at each scale, so a missed region
+    # does not cost a full resolution decode before the cheap reduced frame
+    attempts = []
+    for scale in scales:
+        if region is not None:
+            attempts.append((scale, region))
+        attempts.append((scale, None))
+    barcodes_list = None
+    for scale, attempt_region in attempts:
+        barcodes_list = _decode_barcodes(file_path=file_path, scale=scale, region=attempt_region,
+                                         symbols=zbar_symbols(symbologies), image_data=image_data,
+                                         image_file=image_file)
+        if barcodes_list is _READ_ERROR:
+            return None
+        if barcodes_list and (validator is None or validator(barcodes_list)):
+            counts[('region ' if attempt_region else '') + '1/' + str(scale)] += 1
+            break
+    else:
+        counts['none'] += 1
+        if not barcodes_list:
+            UTILITIES_LOGGER.info('No barcodes found in file: ' + str(file_path))
+    if cache is not None:
+        cache.store(file_path=file_path, name=cache_name, value=barcodes_list)
+    return barcodes_list
+
+
+BARCODE_SCALES = [4, 2, 1]
+BARCODE_SCALE_COUNTS = collections.Counter()
+# Returned by _decode_barcodes when the file could not be read, so read errors are not cached.
+_READ_ERROR = object()
+
 
+def parse_symbologies(symbologies=None):
+    """
+    Parse a comma separated list of symbology names from a config file.
 
     Returns
     -------
     list
-        A list of dicts with the barcode type (symbology)
-        and data (barcode value).
+        Upper case names known to zbar, or None if no valid names are given.
+    """
+    if not symbologies:
+        return None
+    names = []
+    for name in symbologies.split(','):
+        name = name.strip().upper()
+        if not name:
+            continue
+        if name in ZBarSymbol.__members__:
+            names.append(name)
+        else:
+            print('Unknown barcode symbology ignored:', name)
+            UTILITIES_LOGGER.error('Unknown barcode symbology ignored: ' + name)
+    return names or None
+
+
+def zbar_symbols(symbologies=None):
+    """Convert symbology names to the ZBarSymbol values passed to pyzbar, None for all symbologies."""
+    if not symbologies:
+        return None
+    return [ZBarSymbol[name] for name in symbologies]
 
+
+def reduced_image(file_path=None, scale=1, mode=None):
+    """
+    Open an image reduced by an integer scale factor.
+
+    JPEG files are reduced while decoding (PIL draft mode), other formats
+    after loading.
     """
+    image = Image.open(file_path)
+    if scale > 1:
+        size = (max(1, image.size[0] // scale), max(1, image.size[1] // scale))
+        if image.format == 'JPEG':
+            # returns the smallest 1/2, 1/4 or 1/8 decode at least as large as size
+            image.draft(mode or image.mode, size)
+        factor = image.size[0] // size[0]
+        if factor > 1:
+            image = reduce_image(image, factor)
+    if mode is not None and image.mode != mode:
+        image = image.convert(mode)
+    return image
+
+
+def reduce_image(image=None, factor=1):
+    """Reduce a PIL image by an integer factor, averaging factor x factor blocks."""
+    if factor <= 1:
+        return image
+    if hasattr(image, 'reduce'):
+        return image.reduce(factor)
+    # Image.reduce was added in Pillow 7
+    return image.resize((image.size[0] // factor, image.size[1] // factor), Image.BOX)
+
+
+def _decode_barcodes(file_path=None, scale=1, region=None, symbols=None, image_data=None, image_file=None):
     try:
-        barcodes = decode(Image.open(file_path))
+        if image_data is not None:
+            image = reduced_image(file_path=io.BytesIO(image_data), scale=scale, mode='L')
+        elif image_file is not None and scale == 1:
+            image = image_file.grayscale()
+        elif image_file is not None:
+            image = reduced_image(file_path=image_file.stream(), scale=scale, mode='L')
+        else:
+            image = reduced_image(file_path=file_path, scale=scale, mode='L')
+        width, height = image.size
+        left, top = 0, 0
+        if region is not None:
+            left, top = int(region[0] * width), int(region[1] * height)
+            image = image.crop((left, top, int(region[2] * width), int(region[3] * height)))
+        barcodes = decode(image, symbols=symbols)
         barcodes_list = []
         if barcodes:
             # reformat into a list
             for barcode in barcodes:
                 symbology_type = str(barcode.type)
                 data = barcode.data.decode('UTF-8')
-                barcodes_list.append({'type': symbology_type, 'data': data})
+                # position normalized to the whole frame
+                rect = [round((left + barcode.rect.left) / width, 4),
+                        round((top + barcode.rect.top) / height, 4),
+                        round((left + barcode.rect.left + barcode.rect.width) / width, 4),
+                        round((top + barcode.rect.top + barcode.rect.height) / height, 4)]
+                barcodes_list.append({'type': symbology_type, 'data': data, 'rect': rect})
         else:
-            UTILITIES_LOGGER.info('No barcodes found in file: ' + file_path)
             return None
         return barcodes_list
     except OSError as e:
         print('ERROR: unable to read file. errno: ' + str(e.errno) + ' filename: ' + str(e.filename) + ' strerror: ' + str(e.strerror))
         UTILITIES_LOGGER.exception('OSError')
-        return None
+        return _READ_ERROR
 
 
 def sort_barcodes(barcode_list):
@@ -69,29 +227,69 @@ def alphanum_key(s):
     return [int(c) if c.isdigit() else c for c in re.split('([0-9]+)', s)]
 
 
-def md5hash(file_path=None):
+def md5hash(file_path=None, cache=None, image_file=None):
     """
     Generate a md5 checksum of a file.
 
-    This approach ensures larger files can be read into memory.
-
-    From https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
+    If a processing_cache.ProcessingCache is provided, the checksum of an
+    unchanged file is read from the cache. If an image_file.ImageFile is
+    provided, its contents are hashed instead of reading the file again.
     """
     if file_path is not None:
-        hash_md5 = md5()
+        if image_file is not None:
+            if cache is not None:
+                found, hexdigest = cache.lookup(file_path=file_path, name='md5')
+                if found:
+                    return hexdigest
+            try:
+                hexdigest = md5(image_file.data).hexdigest()
+            except PermissionError as e:
+                print('ERROR: PermissionError - unable to read file: ' + file_path)
+                UTILITIES_LOGGER.error('PermissionError - Unable to read file. Errno: ' + str(e.errno) + ' filename: ' + str(e.filename) + ' strerror: ' + str(e.strerror))
+                return None
+            if cache is not None:
+                cache.store(file_path=file_path, name='md5', value=hexdigest)
+            return hexdigest
+        return file_hashes(file_path=file_path, algorithms=['md5'], cache=cache).get('md5')
+    else:
+        UTILITIES_LOGGER.info('No path provided, can not generate MD5 hash.')
+        return None
+
+
+def file_hashes(file_path=None, algorithms=None, cache=None):
+    """
+    Generate checksums of a file in a single read, e.g. md5 and sha256 for fixity.
+
+    Digests of an unchanged file found in the processing cache are not
+    computed again.
+
+    Returns
+    -------
+    dict
+        algorithm name: hex digest, empty if the file can not be read.
+    """
+    if algorithms is None:
+        algorithms = hashing.DEFAULT_ALGORITHMS
+    digests = {}
+    if cache is not None:
+        for algorithm in algorithms:
+            found, hexdigest = cache.lookup(file_path=file_path, name=algorithm)
+            if found:
+                digests[algorithm] = hexdigest
+    missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing:
         try:
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+            computed = hashing.hash_file(file_path=file_path, algorithms=missing)
         except PermissionError as e:
             print('ERROR: PermissionError - unable to read file: ' + file_path)
             # TODO consider suppressing multiple errors using logging filter https://stackoverflow.com/a/44692178/560798
             UTILITIES_LOGGER.error('PermissionError - Unable to read file. Errno: ' + str(e.errno) + ' filename: ' + str(e.filename) + ' strerror: ' + str(e.strerror))
-            return None
-    else:
-        UTILITIES_LOGGER.info('No path provided, can not generate MD5 hash.')
-        return None
+            return {}
+        if cache is not None:
+            for algorithm, hexdigest in computed.items():
+                cache.store(file_path=file_path, name=algorithm, value=hexdigest)
+        digests.update(computed)
+    return digests
 
 
 def creation_date(file_path):
@@ -135,61 +333,21 @@ def creation_date(file_path):
         return datetime.datetime.utcfromtimestamp(int(date)).strftime('%Y-%m-%d %H:%M:%S')
     except OverflowError as e:
         # Getting OverflowError when testing with some files, not sure of root cause
-        # This perhaps is only a problem when the file is read on creation when copied to sesison directory.
-        # It gets read a second time when modified. Need to wait for the copy to finish?
+        # Session files are only read once completely written (see pipeline.WriteCompletionMonitor).
         print('OverflowError: date value: ' + str(date) + ' for file:' + file_path)
         UTILITIES_LOGGER.exception('OverflowError: date:' + str(date) + ' file:' + file_path)
         return None
 
 
-def rename_uniquely(image_path=None, catalog_number=None, image_event_id=None):
-    """
-    Generate a unique file path to rename files based on the catalog number.
-
-    Rename a file in place using the catalog number. If the desired filename exists,
-    the image event UUID is appended.
-    """
-    print(f'rename_uniquely: image_path:{image_path} catalog_number:{catalog_number} image_event_id:{image_event_id}')
-    if image_path is not None:
-        # Construct desired path
-        image_directory, original_image_basename = os.path.split(image_path)
-        image_file_name, image_extension = os.path.splitext(original_image_basename)
-        new_image_path = os.path.join(image_directory, catalog_number + image_extension)
-        # Determine if desired path is unique
-        if os.path.exists(new_image_path):
-            # path_is_unique = False
-            # construct alternative path
-            print('new_image_path exists:', new_image_path , 'generating new path...')
-            new_image_path = os.path.join(image_directory, catalog_number + '_' + image_event_id + image_extension)
-            if os.path.exists(new_image_path):
-                path_is_unique = False
-            else:
-                path_is_unique = True
-                print('New unique path:', new_image_path)
-        else:
-            path_is_unique = True
-    else:
-        # new_image_path = None
-        UTILITIES_LOGGER.error('No image path provided')
-        return None
+def event_json_filename(catalog_number=None, original_filename=None, image_event_id=None):
+    """
+    Generate the file name of an image event JSON record.
 
-    # Check if path is unique
-    if path_is_unique:
-        try:
-            os.rename(image_path, new_image_path)
-            UTILITIES_LOGGER.info('Renaming - source:' + image_path + ' destination: ' + new_image_path)
-            return new_image_path
-        except OSError as e:
-            print('ERROR: unable to read file. errno: ' + str(e.errno) + ' filename: ' + str(e.filename) + ' strerror: ' + str(e.strerror) + ' new_image_path: ' + new_image_path)
-            # Possible problem with character in new filename
-            #print('ALERT - OSError. new path:', new_image_path)
-            UTILITIES_LOGGER.exception('OSError - unspecified problem with path: ' + new_image_path)
-            return None
-        except:
-            print("Unexpected error:", sys.exc_info()[0])
-            UTILITIES_LOGGER.exception('Unexpected error for path: ' + new_image_path + ' ' + sys.exc_info()[0])
-            raise
+    The catalog number is used if it exists, otherwise the original filename
+    and the image event UUID.
+    """
+    # TODO - make sure catalog_number can be used in format_filename
+    if catalog_number:
+        return catalog_number + '.JSON'
     else:
-        print('Image path is not unique:', new_image_path)
-        UTILITIES_LOGGER.error('Image path not unique: ' + new_image_path)
-        return None
+        return str(original_filename) + '_' + image_event_id + '.JSON'
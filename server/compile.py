@@ -1,132 +1,290 @@
 import argparse
-import glob
+import collections
+import concurrent.futures
+import datetime
+import hashlib
 import json
 import os
 import sqlite3 as lite
+import time
 
-# set up argument parser
-ap = argparse.ArgumentParser()
-ap.add_argument("-s", "--source", required=True, \
-                help="Path to the directory that contains the images to be analyzed.")
-
-"""
-ap.add_argument("-o", "--output", required=False, \
-    help="Path to the directory where log file is written.")
-"""
-args = vars(ap.parse_args())
-
-# set up database
-conn = lite.connect('session_images.db')
-cur = conn.cursor()
-try:
-    cur.execute('''CREATE TABLE images (id INTEGER PRIMARY KEY, \
-        session_uuid text, \
-        session_path text, \
-        creator text, \
-        collection_code text, \
-        project_code text, \
-        session_notes text, \
-        session_taxa text, \
-        station_code text, \
-        uuid text, \
-        status text, \
-        original_raw_image text, \
-        new_raw_image text, \
-        raw_image_creation_date text, \
-        raw_image_md5hash text, \
-        original_derived_image text, \
-        new_derived_image text, \
-        original_filename text, \
-        catalog_number text, \
-        sequence text)''')
-except lite.Error as e:
-    print(e)
-"""
-# set up database
-conn = lite.connect('workflow.db')
-cur = conn.cursor()
-try:
-    cur.execute('''CREATE TABLE images (id INTEGER PRIMARY KEY, \
-        batch_id text, batch_path text, batch_flags text, project_id text, \
-        image_event_id text, datetime_analyzed text, \
-        barcodes text, image_classifications text, closest_model text, \
-        image_path text, basename text, file_name text, file_extension text, \
-        file_creation_time text, file_hash text, file_uuid text, derived_from_file text)''')
-except lite.Error as e:
-    print(e)
-"""
-
-directory_path = os.path.realpath(args["source"])
-print('Scanning directory:', directory_path)
-for file_path in sorted(glob.glob(os.path.join(directory_path, '*.JSON')), key=os.path.getmtime): #this file search seems to be case sensitive
-    print(file_path)
-    with open(file_path) as f:
-        d = json.load(f)
-        print(d['session_uuid'])
-        # insert into database
-        cur.execute(\
-        "INSERT INTO images ( \
-            session_uuid, \
-            session_path, \
-            creator, \
-            collection_code, \
-            project_code, \
-            session_notes, \
-            session_taxa, \
-            station_code, \
-            uuid, \
-            status, \
-            original_raw_image, \
-            new_raw_image, \
-            raw_image_creation_date, \
-            raw_image_md5hash, \
-            original_derived_image, \
-            new_derived_image, \
-            original_filename, \
-            catalog_number, \
-            sequence \
-        )\
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? ,?, ?, ?, ?, ? ,?)", \
-        ( \
-            d['session_uuid'], \
-            d['session_path'], \
-            d['creator'], \
-            d['collection_code'], \
-            d['project_code'], \
-            d['session_notes'], \
-            d['session_taxa'], \
-            d['station_code'], \
-            d['id'], \
-            d['status'], \
-            d['original_raw_image'], \
-            d['new_raw_image'], \
-            d['raw_image_creation_date'], \
-            d['raw_image_md5hash'], \
-            d['original_derived_image'], \
-            d['new_derived_image'], \
-            d['original_filename'], \
-            d['catalog_number'], \
-            d['sequence'] \
-        ))
-    conn.commit()
-"""
-'session_uuid'
-'session_path'
-'creator'
-'collection_code'
-'project_code'
-'session_notes'
-'session_taxa'
-'station_code'
-'id'
-'status'
-'original_raw_image'
-'new_raw_image'
-'raw_image_creation_date'
-'raw_image_md5hash'
-'original_derived_image'
-'new_derived_image'
-'original_filename'
-'catalog_number'
-'sequence'
-"""
+import schema
+
+DATABASE_PATH = 'session_images.db'
+BATCH_SIZE = 1000  # rows per executemany call
+# JSON files written to session folders that are not image events, e.g. the client's rename manifests
+IGNORED_SUFFIXES = ('.rename_manifest.json',)
+# images table column: image event JSON key
+COLUMNS = [
+    ('session_uuid', 'session_uuid'),
+    ('session_path', 'session_path'),
+    ('creator', 'creator'),
+    ('collection_code', 'collection_code'),
+    ('project_code', 'project_code'),
+    ('session_notes', 'session_notes'),
+    ('session_taxa', 'session_taxa'),
+    ('station_code', 'station_code'),
+    ('uuid', 'id'),
+    ('status', 'status'),
+    ('original_raw_image', 'original_raw_image'),
+    ('new_raw_image', 'new_raw_image'),
+    ('raw_image_creation_date', 'raw_image_creation_date'),
+    ('raw_image_md5hash', 'raw_image_md5hash'),
+    ('original_derived_image', 'original_derived_image'),
+    ('new_derived_image', 'new_derived_image'),
+    ('original_filename', 'original_filename'),
+    ('catalog_number', 'catalog_number'),
+    ('sequence', 'sequence'),
+    ('barcode_count', 'barcode_count'),
+]
+UUID_INDEX = [column for column, key in COLUMNS].index('uuid')
+STATION_INDEX = [column for column, key in COLUMNS].index('station_code')
+# a changed event JSON replaces the row of its event, matched by uuid
+UPSERT_SQL = 'INSERT INTO images (' + ', '.join(column for column, key in COLUMNS) + ') VALUES (' + \
+             ', '.join('?' for column in COLUMNS) + ') ON CONFLICT(uuid) DO UPDATE SET ' + \
+             ', '.join(column + ' = excluded.' + column for column, key in COLUMNS if column != 'uuid')
+INGESTED_FILE_SQL = 'INSERT OR REPLACE INTO ingested_files (path, size, mtime, sha256, event_uuid, ingested) ' \
+                    'VALUES (?, ?, ?, ?, ?, ?)'
+
+
+def connect(database_path=DATABASE_PATH):
+    """Open the database tuned for bulk loading."""
+    conn = lite.connect(database_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # WAL is consistent after a crash with NORMAL, only the last transaction may be lost
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+    return conn
+
+
+def scan_json_files(directory_path=None):
+    """
+    List the image event JSON files in a tree of station and session folders.
+
+    Each folder is listed once with scandir, which also provides the mtime
+    and size. Extensions are matched case-insensitively.
+
+    Returns
+    -------
+    list
+        (mtime, path, size) sorted by modification time, oldest first.
+    """
+    json_files = []
+    directories = [directory_path]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.upper().endswith('.JSON') and entry.is_file() \
+                            and not entry.name.lower().endswith(IGNORED_SUFFIXES):
+                        stat = entry.stat()
+                        json_files.append((stat.st_mtime, entry.path, stat.st_size))
+        except OSError as e:
+            print('Unable to list', directory, e)
+    json_files.sort()
+    return json_files
+
+
+def parse_record(data=None, file_path=None):
+    """
+    Read the images table values of an image event JSON file.
+
+    Older clients wrote station_code and sequence, current clients write
+    station_id and only set sequence in the GUI, missing values are NULL.
+    barcode_count is NULL if the record has no barcodes list.
+
+    Parameters
+    ----------
+    data : bytes
+        Content of the file.
+    file_path : string
+        Reported if the content can not be read.
+
+    Returns
+    -------
+    tuple
+        Values in COLUMNS order, or None if the file can not be read.
+    """
+    try:
+        d = json.loads(data)
+    except ValueError as e:
+        print('Unable to read', file_path, e)
+        return None
+    if not isinstance(d, dict) or 'id' not in d:
+        print('Not an image event record:', file_path)
+        return None
+    if d.get('station_code') is None:
+        d['station_code'] = d.get('station_id')
+    if 'barcodes' in d:
+        d['barcode_count'] = len(d['barcodes'] or [])
+    return tuple(d.get(key) for column, key in COLUMNS)
+
+
+def read_json_file(json_file=None):
+    """
+    Read, hash and parse a JSON file, run in the worker processes.
+
+    Parameters
+    ----------
+    json_file : tuple
+        (mtime, path, size) from scan_json_files.
+
+    Returns
+    -------
+    tuple
+        (mtime, path, size, sha256, record, seconds), sha256 and record are None if the file can not be read.
+    """
+    mtime, file_path, size = json_file
+    start_time = time.perf_counter()
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        print('Unable to read', file_path, e)
+        return mtime, file_path, size, None, None, time.perf_counter() - start_time
+    sha256 = hashlib.sha256(data).hexdigest()
+    record = parse_record(data, file_path)
+    return mtime, file_path, size, sha256, record, time.perf_counter() - start_time
+
+
+def ingested_files(conn=None):
+    """Return path: (size, mtime, sha256) of the files already compiled."""
+    return {path: (size, mtime, sha256) for path, size, mtime, sha256
+            in conn.execute('SELECT path, size, mtime, sha256 FROM ingested_files')}
+
+
+class StationStats():
+    """Event files read, rows upserted and reading time of an imaging station."""
+
+    def __init__(self):
+        self.files = 0
+        self.rows = 0
+        self.seconds = 0.0  # reading and parsing, summed over the workers
+
+    def report(self, station_code=None):
+        rate = self.rows / self.seconds if self.seconds else 0
+        return f'{station_code}: {self.files} files, {self.rows} rows, {self.seconds:.1f}s, {rate:.0f} rows/s'
+
+
+def ingest(conn=None, json_files=None, batch_size=BATCH_SIZE, force=False, workers=None):
+    """
+    Upsert the records of new and changed JSON files in batches, in a single transaction.
+
+    Worker processes read and parse the files, this process is the only
+    writer. Files are upserted in modification time order so the latest
+    version of an event wins.
+
+    A file with the size and mtime it was compiled with is skipped without
+    being read. A file that was touched but has the same content is only
+    recorded again.
+
+    Parameters
+    ----------
+    json_files : list
+        (mtime, path, size) from scan_json_files.
+    force : bool
+        Read every file, even unchanged ones.
+    workers : int
+        Number of parsing processes, default is the number of CPUs. 1 parses in this process.
+
+    Returns
+    -------
+    tuple
+        (records upserted, files skipped, station code: StationStats)
+    """
+    known_files = {} if force else ingested_files(conn)
+    to_read = []
+    skipped = 0
+    for mtime, file_path, size in json_files:
+        known = known_files.get(file_path)
+        if known is not None and known[0] == size and known[1] == mtime:
+            skipped += 1
+        else:
+            to_read.append((mtime, file_path, size))
+
+    ingested = datetime.datetime.now().isoformat()
+    station_stats = collections.defaultdict(StationStats)
+    count = 0
+    batch = []
+    file_batch = []
+    executor = None
+    if workers != 1 and len(to_read) > batch_size:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        # larger chunks amortize the transfer of results between processes
+        results = executor.map(read_json_file, to_read, chunksize=max(1, min(batch_size, len(to_read) // 64)))
+    else:
+        results = map(read_json_file, to_read)
+    try:
+        with conn:
+            for mtime, file_path, size, sha256, record, seconds in results:
+                if sha256 is None:
+                    continue
+                if record is not None:
+                    stats = station_stats[record[STATION_INDEX] or 'unknown station']
+                    stats.files += 1
+                    stats.seconds += seconds
+                known = known_files.get(file_path)
+                if known is not None and known[2] == sha256:
+                    conn.execute('UPDATE ingested_files SET size = ?, mtime = ? WHERE path = ?',
+                                 (size, mtime, file_path))
+                    skipped += 1
+                    continue
+                if record is None:
+                    continue
+                stats.rows += 1
+                batch.append(record)
+                file_batch.append((file_path, size, mtime, sha256, record[UUID_INDEX], ingested))
+                if len(batch) >= batch_size:
+                    conn.executemany(UPSERT_SQL, batch)
+                    conn.executemany(INGESTED_FILE_SQL, file_batch)
+                    count += len(batch)
+                    batch = []
+                    file_batch = []
+            if batch:
+                conn.executemany(UPSERT_SQL, batch)
+                conn.executemany(INGESTED_FILE_SQL, file_batch)
+                count += len(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return count, skipped, station_stats
+
+
+def main():
+    # set up argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-s", "--source", required=True, nargs="+", \
+                    help="Folders of session folders, or station folders of session folders, searched recursively.")
+    ap.add_argument("-d", "--database", default=DATABASE_PATH, \
+                    help="Path to the SQLite database, default " + DATABASE_PATH + ".")
+    ap.add_argument("-f", "--force", action="store_true", \
+                    help="Read every JSON file, including files compiled before and unchanged since.")
+    ap.add_argument("-w", "--workers", type=int, default=None, \
+                    help="Number of processes parsing JSON files, default is the number of CPUs.")
+    args = vars(ap.parse_args())
+
+    start_time = time.perf_counter()
+    conn = connect(args["database"])
+    schema.migrate(conn)
+    json_files = []
+    for source in args["source"]:
+        directory_path = os.path.realpath(source)
+        print('Scanning directory:', directory_path)
+        json_files.extend(scan_json_files(directory_path))
+    json_files.sort()
+    print(f'Found {len(json_files)} JSON files in {time.perf_counter() - start_time:.1f}s.')
+    count, skipped, station_stats = ingest(conn, json_files, force=args["force"], workers=args["workers"])
+    conn.close()
+    elapsed = time.perf_counter() - start_time
+    for station_code in sorted(station_stats, key=str):
+        print(station_stats[station_code].report(station_code))
+    print(f'Upserted {count} records in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} records/s), '
+          f'{skipped} unchanged files skipped.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Report duplicate and missing data in the compiled session images database."""
+
+import argparse
+import os
+import sqlite3 as lite
+import sys
+import urllib.request
+
+import schema
+
+DATABASE_PATH = 'session_images.db'
+
+
+def duplicate_hashes(conn=None, limit=-1):
+    """Return rows of raw files with the same MD5 hash, e.g. the same file ingested twice, grouped by hash."""
+    # duplicate hashes are found from the hash index alone, only their rows are read
+    return conn.execute('''SELECT images.raw_image_md5hash, images.session_uuid, images.uuid, images.original_raw_image \
+        FROM images JOIN (SELECT raw_image_md5hash FROM images WHERE raw_image_md5hash IS NOT NULL \
+            GROUP BY raw_image_md5hash HAVING COUNT(*) > 1 LIMIT ?) AS duplicates \
+        ON images.raw_image_md5hash = duplicates.raw_image_md5hash \
+        ORDER BY images.raw_image_md5hash, images.raw_image_creation_date''', (limit,))
+
+
+def shared_catalog_numbers(conn=None, limit=-1):
+    """Return catalog numbers imaged in more than one session, with the number of sessions and their UUIDs."""
+    return conn.execute('''SELECT catalog_number, COUNT(DISTINCT session_uuid), GROUP_CONCAT(DISTINCT session_uuid) \
+        FROM images WHERE catalog_number IS NOT NULL \
+        GROUP BY catalog_number HAVING COUNT(DISTINCT session_uuid) > 1 \
+        ORDER BY catalog_number LIMIT ?''', (limit,))
+
+
+def events_without_barcodes(conn=None, limit=-1, session_uuid=None):
+    """
+    Return image events where no barcode was read.
+
+    Rows compiled before barcode_count was added are not reported until they are compiled again.
+    """
+    if session_uuid is None:
+        return conn.execute('''SELECT session_uuid, uuid, original_filename, original_raw_image FROM images \
+            WHERE barcode_count = 0 ORDER BY session_uuid LIMIT ?''', (limit,))
+    return conn.execute('''SELECT session_uuid, uuid, original_filename, original_raw_image FROM images \
+        WHERE barcode_count = 0 AND session_uuid = ? LIMIT ?''', (session_uuid, limit))
+
+
+# report name: (function, column headers)
+REPORTS = {
+    'duplicate-hashes': (duplicate_hashes, ['raw_image_md5hash', 'session_uuid', 'uuid', 'original_raw_image']),
+    'shared-catalog-numbers': (shared_catalog_numbers, ['catalog_number', 'sessions', 'session_uuids']),
+    'no-barcodes': (events_without_barcodes, ['session_uuid', 'uuid', 'original_filename', 'original_raw_image']),
+}
+
+
+def main():
+    # set up argument parser
+    ap = argparse.ArgumentParser(description="Query the database built by compile.py, rows are tab separated.")
+    ap.add_argument("report", choices=sorted(REPORTS), \
+                    help="duplicate-hashes: raw files ingested more than once, " \
+                         "shared-catalog-numbers: catalog numbers imaged in more than one session, " \
+                         "no-barcodes: image events where no barcode was read.")
+    ap.add_argument("-d", "--database", default=DATABASE_PATH, \
+                    help="Path to the SQLite database, default " + DATABASE_PATH + ".")
+    ap.add_argument("-l", "--limit", type=int, default=-1, \
+                    help="Maximum number of hashes, catalog numbers or events reported, default is all.")
+    ap.add_argument("--session", default=None, \
+                    help="Only report events of this session UUID (no-barcodes).")
+    args = vars(ap.parse_args())
+    if args["session"] is not None and args["report"] != 'no-barcodes':
+        ap.error('--session is only used by no-barcodes')
+
+    if not os.path.exists(args["database"]):
+        print('Database not found:', args["database"])
+        sys.exit(1)
+    # reports never change the database
+    conn = lite.connect('file:' + urllib.request.pathname2url(os.path.abspath(args["database"])) + '?mode=ro',
+                        uri=True)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < schema.SCHEMA_VERSION:
+        print('Database schema version', version, 'is older than', str(schema.SCHEMA_VERSION) + ',',
+              'run compile.py on it to upgrade it first.')
+        conn.close()
+        sys.exit(1)
+    report, headers = REPORTS[args["report"]]
+    options = {'limit': args["limit"]}
+    if args["session"] is not None:
+        options['session_uuid'] = args["session"]
+    print('\t'.join(headers))
+    count = 0
+    for row in report(conn, **options):
+        print('\t'.join('' if value is None else str(value) for value in row))
+        count += 1
+    conn.close()
+    print(count, 'rows', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Versioned schema of the compiled session images database."""
+
+SCHEMA_VERSION = 3
+
+
+def _create_tables(conn=None):
+    conn.execute('''CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, \
+        session_uuid text, \
+        session_path text, \
+        creator text, \
+        collection_code text, \
+        project_code text, \
+        session_notes text, \
+        session_taxa text, \
+        station_code text, \
+        uuid text, \
+        status text, \
+        original_raw_image text, \
+        new_raw_image text, \
+        raw_image_creation_date text, \
+        raw_image_md5hash text, \
+        original_derived_image text, \
+        new_derived_image text, \
+        original_filename text, \
+        catalog_number text, \
+        sequence text)''')
+    # JSON files already compiled, unchanged files are skipped
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingested_files (path text PRIMARY KEY, \
+        size integer, \
+        mtime real, \
+        sha256 text, \
+        event_uuid text, \
+        ingested text)''')
+
+
+def _unique_event_uuid(conn=None):
+    # databases compiled before upserts may hold an event more than once, keep its last insert
+    deleted = conn.execute('DELETE FROM images WHERE uuid IS NOT NULL AND id NOT IN '
+                           '(SELECT MAX(id) FROM images WHERE uuid IS NOT NULL GROUP BY uuid)').rowcount
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS images_uuid ON images (uuid)')
+    if deleted:
+        print('Removed', deleted, 'duplicate image event rows.')
+
+
+def _query_indexes(conn=None):
+    # number of barcodes read, NULL for rows compiled before this version
+    conn.execute('ALTER TABLE images ADD COLUMN barcode_count integer')
+    # catalog number lookups, and catalog numbers imaged in more than one session from the index alone
+    conn.execute('CREATE INDEX images_catalog_number ON images (catalog_number, session_uuid)')
+    conn.execute('CREATE INDEX images_raw_image_md5hash ON images (raw_image_md5hash)')
+    conn.execute('CREATE INDEX images_session_uuid ON images (session_uuid)')
+    conn.execute('CREATE INDEX images_no_barcodes ON images (session_uuid) WHERE barcode_count = 0')
+    # compile every file again to fill barcode_count
+    conn.execute('DELETE FROM ingested_files')
+
+
+# Migration to each version in order, MIGRATIONS[n] upgrades version n to n + 1.
+# Databases compiled before versioning are version 0, the tables may already exist.
+MIGRATIONS = [_create_tables, _unique_event_uuid, _query_indexes]
+
+
+def migrate(conn=None):
+    """
+    Upgrade the database to SCHEMA_VERSION, each version in its own transaction.
+
+    The version is kept in PRAGMA user_version.
+
+    Returns
+    -------
+    int
+        Version of the database before the upgrade.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError('Database schema version ' + str(version) + ' is newer than this compiler, ' +
+                           str(SCHEMA_VERSION) + '.')
+    for target_version in range(version + 1, SCHEMA_VERSION + 1):
+        with conn:
+            # DDL does not open a transaction implicitly
+            conn.execute('BEGIN')
+            MIGRATIONS[target_version - 1](conn)
+            conn.execute('PRAGMA user_version = ' + str(target_version))
+        if version:
+            print('Upgraded database schema to version', target_version)
+    return version